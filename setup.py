@@ -26,7 +26,6 @@ requires = {
     'colorama',
     'docopt',
     'jplephem>=2.0',
-    'networkx>=1.11',
     'numpy',
     'progress',
     'represent>=1.4.0',
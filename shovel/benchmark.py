@@ -0,0 +1,125 @@
+# coding: utf-8
+from __future__ import absolute_import, division, print_function
+
+import threading
+import timeit
+
+import numpy as np
+from jplephem.spk import SPK
+from shovel import task
+
+from astrodynamics.lowlevel.cache import Workspace
+from astrodynamics.lowlevel.chebyshev import ChebyshevSegment
+from astrodynamics.lowlevel.ephemerides import JPLEphemeris
+
+
+def _report(name, seconds, count):
+    print('{:24s} {:10.3f} ms  {:10.3f} us/epoch'.format(
+        name, seconds * 1e3, seconds / count * 1e6))
+
+
+def _span(eph, origin, target):
+    """Return the time span covered by every segment on the path."""
+    coverage = [eph._coverage[key] for key, _ in eph._plan(origin, target)]
+    start = max(min(s.start_jd for s in c.segments) for c in coverage)
+    stop = min(max(s.end_jd for s in c.segments) for c in coverage)
+    return start, stop
+
+
+@task
+def chebyshev(kernel, center=0, target=3, epochs=100000, repeat=5):
+    """Compare native Chebyshev evaluation with jplephem for one segment.
+
+    Example: shovel benchmark.chebyshev de421.bsp --epochs=10000
+    """
+    center, target = int(center), int(target)
+    epochs, repeat = int(epochs), int(repeat)
+
+    spk = SPK.open(kernel)
+    segment = spk[center, target]
+    evaluator = ChebyshevSegment(segment)
+
+    rng = np.random.RandomState(0)
+    tdb = np.sort(rng.uniform(segment.start_jd, segment.end_jd, epochs))
+    scalar = tdb[:1000]
+    tdb2 = np.zeros_like(tdb)
+    r, v = np.empty((3, epochs)), np.empty((3, epochs))
+    workspace = Workspace()
+
+    def best(func):
+        return min(timeit.repeat(func, number=1, repeat=repeat))
+
+    print('Segment ({}, {}), {} epochs'.format(center, target, epochs))
+    _report('jplephem array', best(
+        lambda: segment.compute_and_differentiate(tdb)), epochs)
+    _report('native array', best(
+        lambda: evaluator.compute_and_differentiate(tdb)), epochs)
+    _report('native in place', best(
+        lambda: evaluator.evaluate(tdb, tdb2, r, v, workspace)), epochs)
+    _report('jplephem scalar loop', best(
+        lambda: [segment.compute_and_differentiate(t) for t in scalar]),
+        len(scalar))
+    _report('native scalar loop', best(
+        lambda: [evaluator.compute_and_differentiate(t) for t in scalar]),
+        len(scalar))
+    spk.close()
+
+
+@task
+def threads(kernel, origin=0, target=399, epochs=1000, queries=200,
+            max_threads=8):
+    """Measure the query throughput of one ephemeris shared by a growing
+    number of threads.
+
+    Every thread runs `queries` queries of `epochs` epochs each. Use
+    --epochs=1 to measure the overhead of scalar queries.
+
+    Example: shovel benchmark.threads de421.bsp --max_threads=4
+    """
+    origin, target = int(origin), int(target)
+    epochs, queries = int(epochs), int(queries)
+
+    eph = JPLEphemeris()
+    eph.load_kernel(kernel)
+    start, stop = _span(eph, origin, target)
+    rng = np.random.RandomState(0)
+    tdb = rng.uniform(start, stop, epochs)
+    eph.rv(origin, target, tdb)
+
+    def run():
+        for _ in range(queries):
+            eph.rv(origin, target, tdb)
+
+    print('Path ({}, {}), {} epochs per query'.format(origin, target, epochs))
+    for count in range(1, int(max_threads) + 1):
+        workers = [threading.Thread(target=run) for _ in range(count)]
+        start = timeit.default_timer()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        seconds = timeit.default_timer() - start
+        print('{:2d} threads {:12.0f} epochs/s'.format(
+            count, count * queries * epochs / seconds))
+
+
+@task
+def parallel(kernel, origin=0, target=399, epochs=10000000, max_workers=4):
+    """Measure the throughput of JPLEphemeris.parallel_rv as worker
+    processes are added.
+
+    Example: shovel benchmark.parallel de421.bsp --epochs=100000000
+    """
+    origin, target, epochs = int(origin), int(target), int(epochs)
+
+    eph = JPLEphemeris()
+    eph.load_kernel(kernel)
+    start, stop = _span(eph, origin, target)
+    step = (stop - start) / epochs
+
+    print('Path ({}, {}), {} epochs'.format(origin, target, epochs))
+    for workers in range(1, int(max_workers) + 1):
+        begin = timeit.default_timer()
+        eph.parallel_rv([(origin, target)], start, stop, step, workers).close()
+        seconds = timeit.default_timer() - begin
+        print('{:2d} workers {:12.0f} epochs/s'.format(workers, epochs / seconds))
@@ -3,19 +3,26 @@
 
 Usage:
     astrodynamics download_spk [options] <category> <kernel>
+    astrodynamics subset_spk <kernel> <output> <start> <end> <body>...
 
 Options:
     --download-dir <dir>  Default: {default}
 
+Dates are Julian dates or ISO dates in the TDB time scale, bodies are NAIF
+IDs or names.
+
 Example:
     astrodynamics download_spk planets de421
+    astrodynamics subset_spk de421.bsp subset.bsp 2020-01-01 2021-01-01 ssb earth moon
 """
 from __future__ import absolute_import, division, print_function
 
 import sys
 
+from astropy.time import Time
 from docopt import docopt
 
+from .lowlevel.ephemerides import JPLEphemeris
 from .utils import SPK_DIR, SPKDownloadError, download_spk
 
 
@@ -30,6 +37,30 @@ def main():
             download_spk(category=category, kernel=kernel, download_dir=download_dir)
         except SPKDownloadError as e:
             sys.exit(e)
+    elif args['subset_spk']:
+        try:
+            start = _parse_date(args['<start>'])
+            end = _parse_date(args['<end>'])
+            bodies = [_parse_body(body) for body in args['<body>']]
+            with JPLEphemeris() as eph:
+                eph.load_kernel(args['<kernel>'])
+                eph.write_subset(args['<output>'], bodies, start, end)
+        except (IOError, OSError, ValueError) as e:
+            sys.exit(e)
+
+
+def _parse_date(value):
+    try:
+        return float(value)
+    except ValueError:
+        return Time(value, scale='tdb')
+
+
+def _parse_body(value):
+    try:
+        return int(value)
+    except ValueError:
+        return value
 
 
 if __name__ == '__main__':
@@ -67,13 +67,14 @@ class CelestialBody(ReprHelperMixin, object):
     ellipsoid = read_only_property('_ellipsoid')
     mu = read_only_property('_mu')
     mass = read_only_property('_mass')
+    naif_id = read_only_property('_naif_id')
 
     def _repr_helper_(self, r):
         r.keyword_from_attr('name')
         r.keyword_from_attr('ellipsoid')
         # View as Quantity to prevent full Constant repr.
         r.keyword_with_value('mu', self.mu.view(Quantity))
-        r.keyword_from_attr('naif_id', '_naif_id')
+        r.keyword_from_attr('naif_id')
 
 
 G = CONSTANT_OF_GRAVITATION
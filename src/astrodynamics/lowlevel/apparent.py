@@ -0,0 +1,131 @@
+# coding: utf-8
+"""The astrodynamics.lowlevel.apparent module
+
+This module corrects ephemeris states for light time and stellar aberration
+for whole arrays of epochs at once.
+"""
+from __future__ import absolute_import, division, print_function
+
+import numpy as np
+
+from .chebyshev import S_PER_DAY
+
+__all__ = (
+    'CORRECTIONS',
+    'SPEED_OF_LIGHT',
+    'apparent_rv',
+    'stellar_aberration',
+)
+
+SPEED_OF_LIGHT = 299792.458 * S_PER_DAY  # km/day
+
+CORRECTIONS = ('LT', 'LT+S', 'CN', 'CN+S')
+
+
+def apparent_rv(ephemeris, observer, target, tdb, tdb2=0.0, correction='LT',
+                tolerance=1e-13, max_iterations=10):
+    """Compute the apparent position and velocity of `target` as seen from
+    `observer`, like the aberration corrections of the :term:`SPICE toolkit`.
+
+    The light time is found by fixed-point iteration for all epochs at once.
+    After each iteration, only the epochs which have not converged yet are
+    evaluated again.
+
+    Parameters:
+        ephemeris: :py:class:`~astrodynamics.lowlevel.ephemerides.JPLEphemeris`
+        observer: :term:`NAIF ID` of the observer.
+        target: :term:`NAIF ID` of the target.
+        tdb: Julian date (TDB) of the observation, scalar or array of shape
+             (N,).
+        tdb2: Optional second part of the Julian date, scalar or array which
+              is broadcast against `tdb`.
+        correction: One of
+
+                    - ``'LT'``: one light time iteration,
+                    - ``'CN'``: light time iterated until it converges,
+                    - ``'LT+S'``, ``'CN+S'``: as above, followed by the stellar
+                      aberration due to the velocity of the observer.
+        tolerance: Light time change [days] below which ``'CN'`` iterations
+                   have converged.
+        max_iterations: Maximum number of ``'CN'`` iterations.
+
+    Returns:
+        Position [km] and velocity [km/day] arrays with shape (3,) for
+        scalar epochs or (3, N) for epoch arrays, and the one-way light time
+        [days] as a scalar or an array of shape (N,). The velocity is
+        corrected for light time only.
+
+    Raises:
+        ValueError: If `correction` is invalid.
+    """
+    correction = correction.upper()
+    if correction not in CORRECTIONS:
+        raise ValueError('correction must be one of {}.'
+                         .format(', '.join(CORRECTIONS)))
+
+    scalar = np.ndim(tdb) == 0 and np.ndim(tdb2) == 0
+    tdb, tdb2 = np.broadcast_arrays(
+        np.atleast_1d(np.asarray(tdb, dtype=float)),
+        np.atleast_1d(np.asarray(tdb2, dtype=float)))
+
+    r_observer, v_observer = ephemeris.rv(0, observer, tdb, tdb2)
+    r_target, v_target = ephemeris.rv(0, target, tdb, tdb2)
+    light_time = _norm(r_target - r_observer) / SPEED_OF_LIGHT
+
+    iterations = 1 if correction.startswith('LT') else max_iterations
+    active = np.arange(tdb.size)
+    for _ in range(iterations):
+        r, v = ephemeris.rv(
+            0, target, tdb[active], tdb2[active] - light_time[active])
+        r_target[:, active] = r
+        v_target[:, active] = v
+        previous = light_time[active]
+        light_time[active] = _norm(r - r_observer[:, active]) / SPEED_OF_LIGHT
+        converged = np.abs(light_time[active] - previous) <= tolerance
+        active = active[~converged]
+        if not active.size:
+            break
+
+    r = r_target - r_observer
+    distance = _norm(r)
+    light_time = distance / SPEED_OF_LIGHT
+
+    # Differentiate lt = |r_target(t - lt) - r_observer(t)| / c with respect
+    # to t and solve for the rate of change of the light time.
+    u = r / np.where(distance > 0, distance, 1)
+    closing = np.sum(u * (v_target - v_observer), axis=0)
+    rate = closing / (SPEED_OF_LIGHT + np.sum(u * v_target, axis=0))
+    v = v_target * (1 - rate) - v_observer
+
+    if correction.endswith('+S'):
+        r = stellar_aberration(r, v_observer)
+
+    if scalar:
+        return r[:, 0], v[:, 0], light_time[0]
+    return r, v, light_time
+
+
+def stellar_aberration(r, v_observer):
+    """Correct positions for the stellar aberration due to the velocity of
+    the observer, by rotating them towards the velocity like
+    ``STELAB`` of the :term:`SPICE toolkit`.
+
+    Parameters:
+        r: Positions relative to the observer [km], array of shape (3, ...).
+        v_observer: Velocities of the observer relative to the solar system
+                    barycenter [km/day], array of shape (3, ...).
+
+    Returns:
+        Corrected positions, array of shape (3, ...).
+    """
+    r = np.asarray(r, dtype=float)
+    distance = _norm(r)
+    u = r / np.where(distance > 0, distance, 1)
+    # The rotation axis scaled by the sine of the aberration angle.
+    h = np.cross(u, np.asarray(v_observer) / SPEED_OF_LIGHT, axis=0)
+    sine = _norm(h)
+    return r * np.sqrt(1 - sine ** 2) + np.cross(h, r, axis=0)
+
+
+def _norm(r):
+    return np.sqrt(np.sum(r * r, axis=0))
@@ -0,0 +1,165 @@
+# coding: utf-8
+from __future__ import absolute_import, division, print_function
+
+import threading
+from collections import OrderedDict, namedtuple
+
+import numpy as np
+
+__all__ = (
+    'CacheInfo',
+    'LRUCache',
+    'Workspace',
+)
+
+_missing = object()
+
+CacheInfo = namedtuple('CacheInfo', 'hits misses maxsize currsize maxbytes nbytes')
+
+
+class LRUCache(object):
+    """Mapping which evicts the least recently used entries once it holds
+    more than `maxsize` entries or more than `maxbytes` bytes.
+
+    All operations hold an internal lock, so one cache can be shared between
+    threads.
+
+    Parameters:
+        maxsize: Maximum number of entries, or ``None`` for no limit.
+        maxbytes: Maximum total size of the entries, or ``None`` for no limit.
+        getsizeof: Function returning the size of a value in bytes. By
+                   default, the ``nbytes`` of arrays in the value are summed.
+    """
+    def __init__(self, maxsize=128, maxbytes=None, getsizeof=None):
+        if maxsize is not None and maxsize < 0:
+            raise ValueError('maxsize must not be negative.')
+        if maxbytes is not None and maxbytes < 0:
+            raise ValueError('maxbytes must not be negative.')
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.getsizeof = getsizeof or _nbytes
+        self.hits = 0
+        self.misses = 0
+        self.nbytes = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Return the value for `key` and mark it as recently used, or
+        `default` if the key is missing.
+        """
+        with self._lock:
+            item = self._data.pop(key, _missing)
+            if item is _missing:
+                self.misses += 1
+                return default
+            self._data[key] = item
+            self.hits += 1
+            return item[0]
+
+    def set(self, key, value):
+        """Insert or replace `key`, evicting old entries if necessary."""
+        size = self.getsizeof(value) if self.maxbytes is not None else 0
+        with self._lock:
+            self._discard(key)
+            if self.maxsize == 0 or (self.maxbytes is not None and size > self.maxbytes):
+                return
+            self._data[key] = (value, size)
+            self.nbytes += size
+            while self._overfull():
+                _, (_, size) = self._data.popitem(last=False)
+                self.nbytes -= size
+
+    def _overfull(self):
+        if self.maxsize is not None and len(self._data) > self.maxsize:
+            return True
+        return self.maxbytes is not None and self.nbytes > self.maxbytes
+
+    def _discard(self, key):
+        item = self._data.pop(key, _missing)
+        if item is not _missing:
+            self.nbytes -= item[1]
+
+    def clear(self):
+        """Remove all entries. The statistics are kept."""
+        with self._lock:
+            self._data.clear()
+            self.nbytes = 0
+
+    def cleared(self):
+        """Return a new, empty cache with the limits and statistics of this
+        one.
+
+        Unlike :py:meth:`clear`, entries still being computed for this cache
+        can't end up in the new one, which makes it suitable for
+        invalidation while other threads use the cache.
+        """
+        cache = LRUCache(self.maxsize, self.maxbytes, self.getsizeof)
+        with self._lock:
+            cache.hits = self.hits
+            cache.misses = self.misses
+        return cache
+
+    def items(self):
+        """Return a list of the ``(key, value)`` pairs, least recently used
+        first.
+        """
+        with self._lock:
+            return [(key, item[0]) for key, item in self._data.items()]
+
+    def info(self):
+        """Return a :py:class:`CacheInfo` with the hit and miss statistics
+        and the current size.
+        """
+        with self._lock:
+            return CacheInfo(self.hits, self.misses, self.maxsize,
+                             len(self._data), self.maxbytes, self.nbytes)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+
+def _nbytes(value):
+    """Return the total ``nbytes`` of `value`, or of the items of a tuple."""
+    if isinstance(value, tuple):
+        return sum(_nbytes(item) for item in value)
+    return getattr(value, 'nbytes', 0)
+
+
+class Workspace(object):
+    """Pool of named scratch arrays.
+
+    Each name is backed by one flat buffer which grows to the largest size
+    requested and is then reused, so that repeated calls with the same or
+    smaller shapes do not allocate. Arrays returned for the same name share
+    memory and are only valid until the name is requested again.
+
+    A workspace must not be shared between threads.
+    """
+    def __init__(self):
+        self._buffers = {}
+
+    def empty(self, name, shape, dtype=np.float64):
+        """Return an uninitialised array of `shape` backed by buffer `name`."""
+        dtype = np.dtype(dtype)
+        size = 1
+        for length in shape:
+            size *= length
+        buffer = self._buffers.get((name, dtype))
+        if buffer is None or buffer.size < size:
+            buffer = np.empty(size, dtype)
+            self._buffers[name, dtype] = buffer
+        return buffer[:size].reshape(shape)
+
+    def zeros(self, name, shape, dtype=np.float64):
+        """Return an array of zeros of `shape` backed by buffer `name`."""
+        array = self.empty(name, shape, dtype)
+        array.fill(0)
+        return array
+
+    def clear(self):
+        """Release all buffers."""
+        self._buffers.clear()
@@ -0,0 +1,422 @@
+# coding: utf-8
+"""The astrodynamics.lowlevel.chebyshev module
+
+This module evaluates the Chebyshev polynomials of SPK type 2 and 3 segments
+for whole arrays of epochs at once.
+"""
+from __future__ import absolute_import, division, print_function
+
+import numpy as np
+
+from .cache import Workspace
+
+__all__ = (
+    'ChebyshevSegment',
+    'FusedSegment',
+    'S_PER_DAY',
+    'T0',
+)
+
+T0 = 2451545.0
+S_PER_DAY = 86400.0
+
+# Epochs converted from Julian dates may miss the start and end of a segment
+# by this many seconds.
+ROUNDING = 1e-3
+
+
+def clenshaw(coefficients, s, derivative=True, workspace=None):
+    """Evaluate Chebyshev series and optionally their derivatives by Clenshaw
+    recurrence.
+
+    Parameters:
+        coefficients: Array of shape (K, C, N) with K coefficients for each of
+                      the C components of N series.
+        s: Normalised time in [-1, 1] for each of the N series.
+        derivative: Whether to evaluate the derivative with respect to `s`.
+        workspace: Optional :py:class:`~astrodynamics.lowlevel.cache.Workspace`
+                   providing the scratch and result arrays.
+
+    Returns:
+        Values of shape (C, N) and derivatives of shape (C, N), or ``None``
+        if `derivative` is false. When a `workspace` is passed, the results
+        are backed by it.
+    """
+    if workspace is None:
+        workspace = Workspace()
+    shape = coefficients.shape[1:]
+
+    s2 = workspace.empty('clenshaw_s2', s.shape)
+    np.multiply(s, 2.0, out=s2)
+    b1 = workspace.zeros('clenshaw_b1', shape)
+    b2 = workspace.zeros('clenshaw_b2', shape)
+    tmp = workspace.empty('clenshaw_tmp', shape)
+    if derivative:
+        d1 = workspace.zeros('clenshaw_d1', shape)
+        d2 = workspace.zeros('clenshaw_d2', shape)
+
+    for k in range(len(coefficients) - 1, 0, -1):
+        if derivative:
+            # d[k] = 2 * b[k + 1] + 2 * s * d[k + 1] - d[k + 2]
+            np.multiply(d1, s2, out=tmp)
+            tmp -= d2
+            tmp += b1
+            np.add(tmp, b1, out=d2)
+            d1, d2 = d2, d1
+        # b[k] = c[k] + 2 * s * b[k + 1] - b[k + 2]
+        np.multiply(b1, s2, out=tmp)
+        tmp -= b2
+        np.add(tmp, coefficients[k], out=b2)
+        b1, b2 = b2, b1
+
+    values = workspace.empty('clenshaw_values', shape)
+    np.multiply(b1, s, out=values)
+    values -= b2
+    values += coefficients[0]
+    if not derivative:
+        return values, None
+
+    rates = workspace.empty('clenshaw_rates', shape)
+    np.multiply(d1, s, out=rates)
+    rates -= d2
+    rates += b1
+    return values, rates
+
+
+class ChebyshevSegment(object):
+    """Evaluator for an SPK type 2 or 3 segment.
+
+    The coefficient records are mapped from the file once. Each evaluation
+    finds the records for all epochs with a single binary search, gathers
+    their coefficients and evaluates them in one vectorised pass.
+
+    Evaluations with a `tolerance` drop trailing coefficients, see
+    :py:meth:`truncation`.
+
+    Positions are returned in km and velocities in km/day, like
+    :py:mod:`jplephem`.
+
+    Parameters:
+        segment: :py:class:`jplephem.spk.Segment` of type 2 or 3.
+    """
+    def __init__(self, segment):
+        if segment.data_type not in (2, 3):
+            raise ValueError('Only SPK data types 2 and 3 are supported.')
+
+        self.center = segment.center
+        self.target = segment.target
+        self.data_type = segment.data_type
+        self.start_jd = segment.start_jd
+        self.end_jd = segment.end_jd
+        self.start_second = segment.start_second
+        self.end_second = segment.end_second
+
+        daf = segment.daf
+        init, intlen, rsize, n = daf.read_array(segment.end_i - 3, segment.end_i)
+        rsize = int(rsize)
+        n = int(n)
+        components = 3 if self.data_type == 2 else 6
+
+        records = daf.map_array(segment.start_i, segment.end_i - 4)
+        records = records.reshape((n, rsize))
+
+        self.init = init
+        self.intlen = intlen
+        self.starts = init + intlen * np.arange(n)
+        self.records = records
+        self.midpoints = records[:, 0]
+        self.radii = records[:, 1]
+        self.coefficients = records[:, 2:].reshape(
+            (n, components, (rsize - 2) // components))
+        self._tails = None
+
+    @property
+    def tails(self):
+        """Error bounds of truncated series, array of shape (n, K), where
+        element ``[i, m]`` bounds the position error [km] of keeping the
+        first m coefficients of record i.
+
+        As Chebyshev polynomials are bounded by one on [-1, 1], the error of
+        dropping trailing coefficients is bounded by the sum of the norms of
+        their position components. The bounds are computed on first use,
+        which reads the whole segment.
+        """
+        tails = self._tails
+        if tails is None:
+            norms = np.sqrt(np.sum(self.coefficients[:, :3] ** 2, axis=1))
+            tails = np.cumsum(norms[:, ::-1], axis=1)[:, ::-1]
+            self._tails = tails
+        return tails
+
+    def truncation(self, tolerance, index=None):
+        """Return the number of leading coefficients to keep per record for
+        a position error of at most `tolerance` [km], see :py:attr:`tails`.
+
+        Parameters:
+            tolerance: Maximum position error [km].
+            index: Optional array of record indices, by default all records.
+
+        Returns:
+            Array with the number of coefficients for each record in `index`.
+        """
+        tails = self.tails if index is None else self.tails[index]
+        # The bounds decrease with m, so the number of bounds above the
+        # tolerance is the smallest m within it.
+        return np.maximum(np.sum(tails > tolerance, axis=1), 1)
+
+    def _seconds(self, tdb, tdb2):
+        """Return whole and fractional seconds past J2000 for the epochs."""
+        # Keep the whole days and the fractions separate until the offset
+        # from the record midpoint is known to retain precision.
+        seconds = (np.asarray(tdb) - T0) * S_PER_DAY
+        seconds2 = np.asarray(tdb2) * S_PER_DAY
+        return seconds, seconds2
+
+    def _index(self, t):
+        """Return the record index for each epoch `t` in seconds past J2000."""
+        first = self.start_second - ROUNDING
+        last = self.end_second + ROUNDING
+        if np.any(t < first) or np.any(t > last):
+            raise ValueError(
+                'Segment ({}, {}) only covers Julian dates {} through {}.'
+                .format(self.center, self.target, self.start_jd, self.end_jd))
+        # Like jplephem, the end of the last record and any epochs the
+        # segment declares beyond it belong to the last record.
+        index = np.searchsorted(self.starts, t, 'right') - 1
+        return np.clip(index, 0, len(self.starts) - 1)
+
+    def evaluate(self, tdb, tdb2, r, v=None, workspace=None, tolerance=None):
+        """Evaluate the segment for one-dimensional epoch arrays, writing the
+        results into existing arrays.
+
+        Parameters:
+            tdb: Julian date (TDB) array of shape (N,).
+            tdb2: Second part of the Julian date, array of shape (N,).
+            r: Output array of shape (3, N) for the position [km].
+            v: Optional output array of shape (3, N) for the velocity
+               [km/day]. The derivative is only evaluated if it is given.
+            workspace: Optional :py:class:`~astrodynamics.lowlevel.cache.Workspace`
+                       for scratch arrays.
+            tolerance: Optional maximum position error [km]. The series are
+                       truncated to the most coefficients any of the
+                       records of the epochs needs, see :py:meth:`truncation`.
+                       Velocities are evaluated from the truncated series
+                       and are not bounded by it.
+        """
+        if workspace is None:
+            workspace = Workspace()
+        seconds, seconds2 = self._seconds(tdb, tdb2)
+        index = self._index(seconds + seconds2)
+
+        # Gather whole records from the contiguous record array, which is
+        # much faster than gathering from the strided coefficient view.
+        records = workspace.empty(
+            'chebyshev_records', (len(index), self.records.shape[1]),
+            self.records.dtype)
+        np.take(self.records, index, axis=0, out=records, mode='clip')
+        coefficients = records[:, 2:].reshape(
+            (len(index),) + self.coefficients.shape[1:])
+        if v is None:
+            # Type 3 velocity components are not needed either.
+            coefficients = coefficients[:, :3]
+        if tolerance is not None and len(index):
+            count = self.truncation(tolerance, index).max()
+            coefficients = coefficients[..., :count]
+
+        # Reorder to (K, C, N), so that each step of the recurrence works on
+        # contiguous rows of epochs.
+        ordered = workspace.empty(
+            'chebyshev_coefficients', coefficients.shape[::-1])
+        ordered[...] = coefficients.T
+
+        s = workspace.empty('chebyshev_s', index.shape)
+        np.subtract(seconds, records[:, 0], out=s)
+        s += seconds2
+        s /= records[:, 1]
+
+        derivative = v is not None and self.data_type == 2
+        values, rates = clenshaw(ordered, s, derivative, workspace)
+
+        r[...] = values[:3]
+        if v is None:
+            return
+        if self.data_type == 3:
+            np.multiply(values[3:], S_PER_DAY, out=v)
+        else:
+            np.divide(rates, records[:, 1], out=v)
+            v *= S_PER_DAY
+
+    def _evaluate(self, tdb, tdb2, derivative):
+        tdb, tdb2 = np.broadcast_arrays(tdb, tdb2)
+        r = np.empty((3,) + tdb.shape)
+        v = np.empty((3,) + tdb.shape) if derivative else None
+        self.evaluate(
+            tdb.ravel(), tdb2.ravel(), r.reshape((3, -1)),
+            None if v is None else v.reshape((3, -1)))
+        return r, v
+
+    def compute_and_differentiate(self, tdb, tdb2=0.0):
+        """Compute position and velocity for epochs `tdb` plus `tdb2`.
+
+        Returns:
+            Position [km] and velocity [km/day] arrays of shape (3,) for
+            scalar epochs, or (3, ...) for epoch arrays.
+        """
+        return self._evaluate(tdb, tdb2, derivative=True)
+
+    def compute(self, tdb, tdb2=0.0):
+        """Compute position for epochs `tdb` plus `tdb2`, without evaluating
+        the derivative.
+
+        Returns:
+            Position [km] array of shape (3,) for scalar epochs, or (3, ...)
+            for epoch arrays.
+        """
+        r, _ = self._evaluate(tdb, tdb2, derivative=False)
+        return r
+
+
+class FusedSegment(object):
+    """Chebyshev series for the state of `target` relative to `origin` along
+    a path of several segments, fused into one set of records.
+
+    Within each record, every segment on the path is a single polynomial,
+    so their sum is a polynomial of the same degree. Each record holds
+    series for the three position and three velocity components of that
+    sum, and one evaluation replaces evaluating and adding the segments.
+
+    Parameters:
+        origin: :term:`NAIF ID` of the origin.
+        target: :term:`NAIF ID` of the target.
+        breakpoints: Record boundaries in seconds past J2000 (TDB), array of
+                     shape (n + 1,).
+        coefficients: Array of shape (n, 6, K) with K coefficients per
+                      record and component, positions in km and velocities
+                      in km/day.
+    """
+    def __init__(self, origin, target, breakpoints, coefficients):
+        breakpoints = np.asarray(breakpoints, dtype=float)
+        coefficients = np.asarray(coefficients, dtype=float)
+        if breakpoints.ndim != 1 or len(breakpoints) < 2:
+            raise ValueError('At least two breakpoints are required.')
+        shape = (len(breakpoints) - 1, 6)
+        if coefficients.ndim != 3 or coefficients.shape[:2] != shape:
+            raise ValueError('coefficients must have shape (n, 6, K) for n + 1 '
+                             'breakpoints.')
+        if coefficients.shape[2] == 0:
+            raise ValueError('At least one coefficient per record is required.')
+
+        self.origin = origin
+        self.target = target
+        self.breakpoints = breakpoints
+        self.midpoints = (breakpoints[1:] + breakpoints[:-1]) / 2
+        self.radii = (breakpoints[1:] - breakpoints[:-1]) / 2
+        self.coefficients = coefficients
+
+    @property
+    def start(self):
+        """First Julian date (TDB) covered."""
+        return T0 + self.breakpoints[0] / S_PER_DAY
+
+    @property
+    def stop(self):
+        """Last Julian date (TDB) covered."""
+        return T0 + self.breakpoints[-1] / S_PER_DAY
+
+    @classmethod
+    def fit(cls, compute, origin, target, breakpoints, count):
+        """Create fused series from the states of the path.
+
+        The states are computed at the Chebyshev nodes of each record and
+        transformed into coefficients, which is exact up to rounding as long
+        as the states are polynomials of degree less than `count` within
+        each record.
+
+        Parameters:
+            compute: Function of the two parts of Julian dates (TDB) arrays
+                     of shape (N,) returning position [km] and velocity
+                     [km/day] arrays of shape (3, N).
+            origin: :term:`NAIF ID` of the origin.
+            target: :term:`NAIF ID` of the target.
+            breakpoints: Record boundaries in seconds past J2000 (TDB).
+            count: Number of coefficients per record and component.
+        """
+        self = cls(origin, target, breakpoints,
+                   np.zeros((len(breakpoints) - 1, 6, count)))
+        angles = np.pi * (np.arange(count) + 0.5) / count
+        nodes = np.cos(angles)
+
+        # Whole days and fractions kept apart to retain precision.
+        days = np.floor(self.midpoints / S_PER_DAY)
+        fractions = self.midpoints - days * S_PER_DAY
+        tdb = np.repeat(T0 + days, count)
+        tdb2 = (fractions[:, np.newaxis] + np.outer(self.radii, nodes)).ravel()
+        r, v = compute(tdb, tdb2 / S_PER_DAY)
+        values = np.concatenate([r, v]).reshape((6, -1, count))
+
+        # Discrete Chebyshev transform of the values at the nodes.
+        transform = np.cos(np.outer(np.arange(count), angles)) * (2 / count)
+        transform[0] /= 2
+        self.coefficients[...] = np.einsum('cnj,kj->nck', values, transform)
+        return self
+
+    def covers(self, tdb, tdb2=0.0):
+        """Return whether all epochs `tdb` plus `tdb2` lie within the
+        records.
+        """
+        t = (np.asarray(tdb) - T0) * S_PER_DAY + np.asarray(tdb2) * S_PER_DAY
+        first, last = self.breakpoints[[0, -1]]
+        return bool(np.all((t >= first) & (t <= last)))
+
+    def evaluate(self, tdb, tdb2, r, v=None, workspace=None):
+        """Evaluate the series for one-dimensional epoch arrays, writing the
+        results into existing arrays.
+
+        Parameters:
+            tdb: Julian date (TDB) array of shape (N,).
+            tdb2: Second part of the Julian date, array of shape (N,).
+            r: Output array of shape (3, N) for the position [km].
+            v: Optional output array of shape (3, N) for the velocity
+               [km/day].
+            workspace: Optional :py:class:`~astrodynamics.lowlevel.cache.Workspace`
+                       for scratch arrays.
+
+        Raises:
+            ValueError: If an epoch lies outside of the records.
+        """
+        if workspace is None:
+            workspace = Workspace()
+        tdb, tdb2 = np.broadcast_arrays(tdb, tdb2)
+        seconds = (tdb - T0) * S_PER_DAY
+        seconds2 = tdb2 * S_PER_DAY
+        t = seconds + seconds2
+        breakpoints = self.breakpoints
+        if np.any(t < breakpoints[0]) or np.any(t > breakpoints[-1]):
+            raise ValueError('Fused segment ({}, {}) only covers Julian dates '
+                             '{} through {}.'.format(self.origin, self.target,
+                                                     self.start, self.stop))
+        index = np.searchsorted(breakpoints, t, 'right') - 1
+        np.clip(index, 0, len(self.radii) - 1, out=index)
+
+        # Gather into scratch arrays, like ChebyshevSegment.evaluate.
+        coefficients = workspace.empty(
+            'fused_records', (len(index),) + self.coefficients.shape[1:])
+        np.take(self.coefficients, index, axis=0, out=coefficients)
+        if v is None:
+            coefficients = coefficients[:, :3]
+        ordered = workspace.empty(
+            'fused_coefficients', coefficients.shape[::-1])
+        ordered[...] = coefficients.T
+
+        s = workspace.empty('fused_s', index.shape)
+        np.take(self.midpoints, index, out=s)
+        np.subtract(seconds, s, out=s)
+        s += seconds2
+        radii = workspace.empty('fused_radii', index.shape)
+        np.take(self.radii, index, out=radii)
+        s /= radii
+
+        values, _ = clenshaw(ordered, s, False, workspace)
+        r[...] = values[:3]
+        if v is not None:
+            v[...] = values[3:]
@@ -0,0 +1,212 @@
+# coding: utf-8
+"""The astrodynamics.lowlevel.discrete module
+
+This module interpolates the discrete states of SPK type 9 (Lagrange) and 13
+(Hermite) segments, as used by spacecraft kernels, for whole arrays of epochs
+at once.
+"""
+from __future__ import absolute_import, division, print_function
+
+import numpy as np
+
+from .chebyshev import ROUNDING, S_PER_DAY, T0
+
+__all__ = (
+    'DiscreteSegment',
+)
+
+# Every DIRECTORY_STEP-th epoch is stored again in the epoch directory.
+DIRECTORY_STEP = 100
+
+
+class DiscreteSegment(object):
+    """Evaluator for an SPK type 9 or 13 segment.
+
+    The states and epochs are mapped from the file once. Each evaluation
+    finds the interpolation windows for all epochs with a binary search on the
+    epoch directory followed by a comparison within the directory interval,
+    and interpolates all windows in one vectorised pass, selecting the
+    windows like the :term:`SPICE toolkit`.
+
+    Type 9 segments interpolate each of the six state components by a
+    Lagrange polynomial, type 13 segments interpolate the positions and their
+    derivatives by a Hermite polynomial.
+
+    Positions are returned in km and velocities in km/day, like
+    :py:mod:`jplephem`.
+
+    Parameters:
+        segment: :py:class:`jplephem.spk.BaseSegment` of type 9 or 13.
+    """
+    def __init__(self, segment):
+        if segment.data_type not in (9, 13):
+            raise ValueError('Only SPK data types 9 and 13 are supported.')
+
+        self.center = segment.center
+        self.target = segment.target
+        self.data_type = segment.data_type
+        self.start_jd = segment.start_jd
+        self.end_jd = segment.end_jd
+
+        daf = segment.daf
+        degree, n = daf.read_array(segment.end_i - 1, segment.end_i)
+        n = int(n)
+        # The trailer holds the window size minus one for both types: the
+        # polynomial degree for type 9, but not for type 13, whose Hermite
+        # polynomials through W states are of degree 2 W - 1.
+        self.window = min(int(degree) + 1, n)
+
+        data = daf.map_array(segment.start_i, segment.end_i - 2)
+        self.states = data[:6 * n].reshape((n, 6))
+        self.epochs = data[6 * n:7 * n]
+        self.directory = data[7 * n:7 * n + (n - 1) // DIRECTORY_STEP]
+
+    def _seconds(self, tdb, tdb2):
+        """Return whole and fractional seconds past J2000 for the epochs."""
+        seconds = (np.asarray(tdb) - T0) * S_PER_DAY
+        seconds2 = np.asarray(tdb2) * S_PER_DAY
+        return seconds, seconds2
+
+    def _window(self, t):
+        """Return the index of the first state of the window for each epoch
+        `t` in seconds past J2000.
+        """
+        epochs = self.epochs
+        n = len(epochs)
+        first, last = epochs[0] - ROUNDING, epochs[-1] + ROUNDING
+        if np.any(t < first) or np.any(t > last):
+            raise ValueError(
+                'Segment ({}, {}) only covers Julian dates {} through {}.'
+                .format(self.center, self.target, self.start_jd, self.end_jd))
+
+        # The directory narrows each epoch down to DIRECTORY_STEP epochs,
+        # which are then bisected for all epochs at once. `low` ends up as
+        # the number of epochs before t. Converged epochs are left alone.
+        low = np.searchsorted(self.directory, t, 'left') * DIRECTORY_STEP
+        high = np.minimum(low + DIRECTORY_STEP, n)
+        active = low < high
+        while np.any(active):
+            middle = (low + high) // 2
+            before = epochs[np.minimum(middle, n - 1)] < t
+            low = np.where(active & before, middle + 1, low)
+            high = np.where(active & ~before, middle, high)
+            active = low < high
+        before = low
+
+        window = self.window
+        if window % 2:
+            # Odd windows are centred on the nearest epoch, the earlier one
+            # on ties.
+            low = np.maximum(before - 1, 0)
+            high = np.minimum(before, n - 1)
+            nearer = np.abs(epochs[high] - t) < np.abs(t - epochs[low])
+            start = np.where(nearer, high, low) - (window - 1) // 2
+        else:
+            # Even windows have as many epochs before t as at or after it.
+            start = before - window // 2
+        # Windows are shifted to lie within the states at the ends.
+        return np.clip(start, 0, n - window)
+
+    def evaluate(self, tdb, tdb2, r, v=None, workspace=None, tolerance=None):
+        """Evaluate the segment for one-dimensional epoch arrays, writing the
+        results into existing arrays.
+
+        Parameters:
+            tdb: Julian date (TDB) array of shape (N,).
+            tdb2: Second part of the Julian date, array of shape (N,).
+            r: Output array of shape (3, N) for the position [km].
+            v: Optional output array of shape (3, N) for the velocity
+               [km/day].
+            workspace: Unused, for compatibility with
+                       :py:class:`~astrodynamics.lowlevel.chebyshev.ChebyshevSegment`.
+            tolerance: Unused, the interpolation is not truncated.
+        """
+        seconds, seconds2 = self._seconds(tdb, tdb2)
+        start = self._window(seconds + seconds2)
+        index = start[:, np.newaxis] + np.arange(self.window)
+
+        # Epochs of the window relative to the requested epochs, which keeps
+        # the differences small.
+        x = self.epochs[index] - seconds[:, np.newaxis]
+        x -= seconds2[:, np.newaxis]
+        states = self.states[index]
+
+        if self.data_type == 9:
+            weights = _lagrange_weights(x)
+            components = states if v is not None else states[..., :3]
+            values = np.einsum('nw,nwc->cn', weights, components)
+            r[...] = values[:3]
+            if v is not None:
+                np.multiply(values[3:], S_PER_DAY, out=v)
+        else:
+            position, velocity = _hermite(x, states[..., :3], states[..., 3:])
+            r[...] = position
+            if v is not None:
+                np.multiply(velocity, S_PER_DAY, out=v)
+
+    def _evaluate(self, tdb, tdb2, derivative):
+        tdb, tdb2 = np.broadcast_arrays(tdb, tdb2)
+        r = np.empty((3,) + tdb.shape)
+        v = np.empty((3,) + tdb.shape) if derivative else None
+        self.evaluate(
+            tdb.ravel(), tdb2.ravel(), r.reshape((3, -1)),
+            None if v is None else v.reshape((3, -1)))
+        return r, v
+
+    def compute(self, tdb, tdb2=0.0):
+        """Compute the position [km] for scalar or array epochs."""
+        return self._evaluate(tdb, tdb2, False)[0]
+
+    def compute_and_differentiate(self, tdb, tdb2=0.0):
+        """Compute the position [km] and velocity [km/day] for scalar or
+        array epochs.
+        """
+        return self._evaluate(tdb, tdb2, True)
+
+
+def _lagrange_weights(x):
+    """Return the weights of the Lagrange polynomials through nodes `x` of
+    shape (N, W) at zero.
+    """
+    window = x.shape[1]
+    differences = x[:, :, np.newaxis] - x[:, np.newaxis]
+    # Replace the diagonal, which is left out of the products.
+    diagonal = np.arange(window)
+    differences[:, diagonal, diagonal] = 1
+    numerators = np.repeat(-x[:, np.newaxis], window, axis=1)
+    numerators[:, diagonal, diagonal] = 1
+    return np.prod(numerators / differences, axis=2)
+
+
+def _hermite(x, f, df):
+    """Evaluate the Hermite polynomials through values `f` and derivatives
+    `df` of shape (N, W, C) at nodes `x` of shape (N, W), and their
+    derivatives, at zero.
+
+    Returns:
+        Values and derivatives, arrays of shape (C, N).
+    """
+    # Newton divided differences on the doubled nodes.
+    z = np.repeat(x, 2, axis=1)[..., np.newaxis]
+    table = np.repeat(f, 2, axis=1)
+    coefficients = [table[:, 0]]
+    for order in range(1, z.shape[1]):
+        dz = z[:, order:] - z[:, :-order]
+        if order == 1:
+            # Differences between equal nodes are the derivatives.
+            quotients = np.empty(table[:, 1:].shape)
+            quotients[:, 0::2] = df
+            quotients[:, 1::2] = np.diff(f, axis=1) / dz[:, 1::2]
+        else:
+            quotients = np.diff(table, axis=1) / dz
+        table = quotients
+        coefficients.append(table[:, 0])
+
+    # Horner scheme for the value and the derivative at zero.
+    value = coefficients[-1]
+    derivative = np.zeros_like(value)
+    for order in range(z.shape[1] - 2, -1, -1):
+        factor = -z[:, order]
+        derivative = derivative * factor + value
+        value = value * factor + coefficients[order]
+    return value.T, derivative.T
@@ -7,55 +7,1283 @@ library by Brandon Rhodes.
 
 from __future__ import absolute_import, division, print_function
 
+import mmap
+import numbers
+import os
+import threading
+import weakref
+from collections import defaultdict, deque
+from functools import partial
+
 import jplephem.spk as spk
-import networkx as nx
 import numpy as np
+from astropy.time import Time
+from six import string_types
+
+from .apparent import apparent_rv
+from .cache import LRUCache, Workspace
+from .chebyshev import S_PER_DAY, T0, ChebyshevSegment, FusedSegment
+from .discrete import DiscreteSegment
+from .spkwriter import cut_segment, write_spk
+from .tables import InterpolationTable
+
+# Open kernels by file identity, see open_kernel.
+_registry = {}
+_registry_lock = threading.RLock()
+
+# Last Time converted by _tdb, as (weak reference, jd1, jd2).
+_last_time = (None, None, None)
+
+# Normalised body names to NAIF IDs, see resolve_body.
+_names = None
+
+
+def resolve_body(body):
+    """Return the :term:`NAIF ID` of `body`.
+
+    Parameters:
+        body: :term:`NAIF ID`,
+              :py:class:`~astrodynamics.bodies.celestialbody.CelestialBody` or
+              name. Names are looked up case-insensitively in an index of the
+              bodies in :py:mod:`astrodynamics.bodies` and the names known to
+              :py:mod:`jplephem`, e.g. ``'Earth'``, ``'moon'`` or ``'SSB'``.
+
+    Raises:
+        ValueError: If the name is unknown.
+        TypeError: If `body` is of another type.
+    """
+    if isinstance(body, numbers.Integral):
+        return int(body)
+    if isinstance(body, string_types):
+        try:
+            return _name_index()[_normalize_name(body)]
+        except KeyError:
+            raise ValueError('Unknown body {!r}.'.format(body))
+    naif_id = getattr(body, 'naif_id', None)
+    if naif_id is None:
+        raise TypeError('Expected a NAIF ID, name or CelestialBody, got {!r}.'
+                        .format(body))
+    return naif_id
+
+
+def _normalize_name(name):
+    return ' '.join(name.upper().replace('_', ' ').split())
+
+
+def _name_index():
+    global _names
+    if _names is None:
+        # Imported here, as the bodies module pulls in astropy units and
+        # the constants.
+        from jplephem.names import target_name_pairs
+
+        from .. import bodies
+
+        names = {}
+        for naif_id, name in target_name_pairs:
+            names.setdefault(_normalize_name(name), naif_id)
+        for body in vars(bodies).values():
+            if isinstance(body, bodies.CelestialBody):
+                names[_normalize_name(body.name)] = body.naif_id
+        _names = names
+    return _names
+
+
+def open_kernel(path, metadata_dir=None):
+    """Open the SPK kernel at `path`, or return the kernel opened before for
+    the same file if it is still in use.
+
+    Files are identified by their resolved path, device, inode and
+    modification time, so a kernel replaced on disk is opened again. The
+    registry only holds weak references; a kernel's file is closed once the
+    last reference to it is gone. Kernels returned by this function are
+    shared and must not be closed by their users.
+
+    Parameters:
+        path: File name of the kernel.
+        metadata_dir: Optional directory of a segment metadata cache, see
+                      :py:func:`~astrodynamics.lowlevel.metadata.open_spk`.
+
+    Returns:
+        :py:class:`jplephem.spk.SPK`
+    """
+    path = os.path.realpath(path)
+    stat = os.stat(path)
+    key = (path, stat.st_dev, stat.st_ino, stat.st_mtime)
+    with _registry_lock:
+        ref = _registry.get(key)
+        kernel = ref() if ref is not None else None
+        if kernel is None:
+            if metadata_dir is None:
+                kernel = spk.SPK.open(path)
+            else:
+                from .metadata import open_spk
+                kernel = open_spk(path, metadata_dir)
+            _registry[key] = weakref.ref(
+                kernel, partial(_release_kernel, key, kernel.daf.file))
+        return kernel
+
+
+def _release_kernel(key, file, ref):
+    file.close()
+    with _registry_lock:
+        if _registry.get(key) is ref:
+            del _registry[key]
+
+
+class _Coverage(object):
+    """Time coverage index of the segments for one ``(center, target)`` pair.
+
+    The union of all segment start and end epochs splits time into elementary
+    intervals, each of which is assigned the segment with the highest
+    priority covering it. Looking up a segment is then a binary search.
+
+    Parameters:
+        segments: Segments in ascending order of priority.
+    """
+    def __init__(self, segments):
+        self.segments = segments
+        self._evaluators = [None] * len(segments)
+        starts = [segment.start_jd for segment in segments]
+        ends = [segment.end_jd for segment in segments]
+        self.breakpoints = np.unique(starts + ends)
+
+        # Paint the intervals in ascending order of priority, so that later
+        # segments overwrite earlier ones. The -1 sentinels at both ends mark
+        # epochs outside of the breakpoints as uncovered.
+        self.winners = np.full(len(self.breakpoints) + 1, -1, dtype=int)
+        for i, (start, end) in enumerate(zip(starts, ends)):
+            a = np.searchsorted(self.breakpoints, start)
+            b = np.searchsorted(self.breakpoints, end)
+            self.winners[a + 1:b + 1] = i
+
+    def select(self, jd):
+        """Return the index of the segment to use for each epoch in `jd`.
+
+        Raises:
+            ValueError: An epoch is not covered by any segment.
+        """
+        # Segments include their end epoch, so an epoch on a breakpoint is
+        # covered by the winners of the intervals on either side of it.
+        after = self.winners[np.searchsorted(self.breakpoints, jd, 'right')]
+        before = self.winners[np.searchsorted(self.breakpoints, jd, 'left')]
+        winners = np.maximum(after, before)
+        if np.any(winners < 0):
+            segment = self.segments[0]
+            raise ValueError(
+                'No segment for pair ({}, {}) covers the requested epochs.'
+                .format(segment.center, segment.target))
+        return winners
+
+    def evaluator(self, i):
+        """Return the evaluator for segment `i`, creating it on first use.
+
+        Type 2 and 3 segments are evaluated by
+        :py:class:`~astrodynamics.lowlevel.chebyshev.ChebyshevSegment`, type 9
+        and 13 segments by
+        :py:class:`~astrodynamics.lowlevel.discrete.DiscreteSegment`, other
+        segments by :py:mod:`jplephem` itself.
+        """
+        evaluator = self._evaluators[i]
+        if evaluator is None:
+            segment = self.segments[i]
+            data_type = getattr(segment, 'data_type', None)
+            if data_type in (2, 3):
+                evaluator = ChebyshevSegment(segment)
+            elif data_type in (9, 13):
+                evaluator = DiscreteSegment(segment)
+            else:
+                evaluator = _SegmentAdapter(segment)
+            self._evaluators[i] = evaluator
+        return evaluator
 
 
 class JPLEphemeris(object):
+    """Wrapper around one or more JPL SPK kernels.
+
+    Kernels can be loaded together, for example a planetary kernel and a
+    satellite kernel. Where segments for the same pair of bodies overlap in
+    time, segments from later loaded kernels take precedence, as in the
+    :term:`SPICE toolkit`.
+
+    Paths between bodies are resolved on demand by a breadth-first search
+    over the segments, and the resulting plans are cached.
+
+    Intermediate results are kept in scratch arrays owned by the instance and
+    reused between queries. Together with the ``out`` parameters of the query
+    methods, a loop of queries with the same shapes does not allocate new
+    result arrays.
+
+    Bodies can be given by :term:`NAIF ID`, as
+    :py:class:`~astrodynamics.bodies.celestialbody.CelestialBody` objects or
+    by name, see :py:func:`resolve_body`. They are resolved once per query.
+
+    Epochs can be given as two-part Julian dates (TDB) or as
+    :py:class:`~astropy.time.Time` objects in any scale. The last converted
+    :py:class:`~astropy.time.Time` is remembered, so that queries repeated
+    for the same object convert it only once; changing its values in place
+    is therefore not supported.
+
+    Queries for scalar epochs can be memoised with :py:meth:`enable_cache`,
+    so that asking for the same state again costs a dictionary lookup.
+
+    States of frequently queried pairs can be served from interpolation
+    tables created with :py:meth:`precompute` or loaded with
+    :py:meth:`add_table`, or from the fused series of multi-hop paths created
+    with :py:meth:`fuse`. Queries with all epochs inside a table bypass the
+    kernels.
+
+    Thread safety:
+        One instance can be shared by any number of threads once its kernels
+        are loaded. Queries only read the segment index, the path and state
+        caches lock themselves, and each thread gets its own scratch arrays.
+        The NumPy operations which do the numerical work release the global
+        interpreter lock for large arrays, so queries for many epochs at once run
+        in parallel. Loading kernels and changing tables or the state cache
+        is serialised by a lock and replaces the shared structures as a
+        whole, so it is safe while other threads query, but queries already
+        running may still return results computed without the change.
+
+    Pickling an instance only stores the file names of its kernels, the
+    cached paths and the cache settings, so it is cheap to send to other
+    processes. The unpickled instance opens the kernels on first use and, as
+    they are memory mapped, shares their pages with other processes.
+    Interpolation tables and cached states are not pickled.
+
+    :py:meth:`close` releases the kernels, and instances can be used as
+    context managers which close them on exit.
+
+    Parameters:
+        plan_cache_size: Number of resolved ``(origin, target)`` paths to keep.
+        cache_size: If given, enable the state cache with this many entries.
+        cache_bytes: If given, enable the state cache with this size limit.
+        metadata_dir: Optional directory in which to cache the segment
+                      summaries of loaded kernels, so that loading them again
+                      in later processes skips parsing them, for example
+                      :py:const:`~astrodynamics.utils.SPK_METADATA_DIR`.
+    """
+    def __init__(self, plan_cache_size=1024, cache_size=None, cache_bytes=None,
+                 metadata_dir=None):
+        self.metadata_dir = metadata_dir
+        self._kernels = []
+        self._paths = []
+        self._pending = ()
+        self._coverage = {}
+        self._adjacency = {}
+        self._plans = LRUCache(maxsize=plan_cache_size)
+        self._local = threading.local()
+        self._lock = threading.RLock()
+        self._cache = None
+        self._tables = {}
+        if cache_size is not None or cache_bytes is not None:
+            self.enable_cache(maxsize=cache_size, maxbytes=cache_bytes)
+
     def load_kernel(self, spk_file):
-        self._kernel = spk.SPK.open(spk_file)
-        self.generate_paths()
+        """Load an SPK kernel in addition to previously loaded kernels.
+
+        Kernels are opened by :py:func:`open_kernel`, so instances loading
+        the same file share one kernel object and memory map.
+        """
+        self._open_pending()
+        path = os.path.realpath(spk_file)
+        self._add_kernel(open_kernel(path, self.metadata_dir), path)
+
+    def _add_kernel(self, kernel, path=None):
+        with self._lock:
+            self._kernels = self._kernels + [kernel]
+            self._paths = self._paths + [path]
+            self._build_index()
+
+    def _open_pending(self):
+        """Open the kernels of an unpickled instance, keeping the cached
+        paths.
+        """
+        if not self._pending:
+            return
+        with self._lock:
+            if not self._pending:
+                return
+            plans = self._plans.items()
+            self._kernels = [
+                open_kernel(path, self.metadata_dir) for path in self._pending]
+            self._paths = list(self._pending)
+            self._build_index()
+            for key, plan in plans:
+                self._plans.set(key, plan)
+            self._pending = ()
+
+    def __getstate__(self):
+        paths = self.kernel_paths
+        if None in paths:
+            raise TypeError('Only ephemerides with kernels loaded from files '
+                            'can be pickled.')
+        cache = self._cache
+        return {
+            'paths': paths,
+            'plan_cache_size': self._plans.maxsize,
+            'plans': self._plans.items(),
+            'cache': None if cache is None else (cache.maxsize, cache.maxbytes),
+            'metadata_dir': self.metadata_dir,
+        }
 
-    def generate_paths(self):
-        graph = nx.Graph()
-        for edge in self.kernel.pairs:
-            graph.add_edge(*edge)
-        self.paths = nx.shortest_path(graph)
+    def __setstate__(self, state):
+        self.__init__(plan_cache_size=state['plan_cache_size'],
+                      metadata_dir=state['metadata_dir'])
+        if state['cache'] is not None:
+            self.enable_cache(*state['cache'])
+        for key, plan in state['plans']:
+            self._plans.set(key, plan)
+        self._pending = tuple(state['paths'])
+
+    @property
+    def _workspace(self):
+        """Scratch arrays of the current thread."""
+        workspace = getattr(self._local, 'workspace', None)
+        if workspace is None:
+            workspace = self._local.workspace = Workspace()
+        return workspace
+
+    def _build_index(self):
+        """Index the segments of all kernels by the bodies they connect and by
+        their time coverage.
+        """
+        segments = defaultdict(list)
+        for kernel in self._kernels:
+            for segment in kernel.segments:
+                segments[segment.center, segment.target].append(segment)
+
+        adjacency = defaultdict(list)
+        for center, target in segments:
+            adjacency[center].append((target, (center, target), 1))
+            adjacency[target].append((center, (center, target), -1))
+
+        self._coverage = dict(
+            (key, _Coverage(value)) for key, value in segments.items())
+        self._adjacency = dict(
+            (body, tuple(edges)) for body, edges in adjacency.items())
+        # Replace rather than clear the caches, so that queries in other
+        # threads can't store stale entries in them.
+        self._plans = self._plans.cleared()
+        cache = self._cache
+        if cache is not None:
+            self._cache = cache.cleared()
+
+    def enable_cache(self, maxsize=4096, maxbytes=None):
+        """Memoise states queried for scalar epochs, keyed by
+        ``(origin, target, tdb, tdb2)``. Any existing cache is replaced.
+
+        Parameters:
+            maxsize: Maximum number of entries, or ``None`` for no limit.
+            maxbytes: Maximum size of the cached arrays in bytes, or ``None``
+                      for no limit.
+
+        The least recently used entries are evicted first.
+        """
+        with self._lock:
+            self._cache = LRUCache(maxsize=maxsize, maxbytes=maxbytes)
+
+    def disable_cache(self):
+        """Stop memoising states and discard the cache."""
+        with self._lock:
+            self._cache = None
+
+    def cache_info(self):
+        """Return hit and miss statistics of the state cache as a
+        :py:class:`~astrodynamics.lowlevel.cache.CacheInfo`, or ``None`` if
+        the cache is disabled.
+        """
+        if self._cache is None:
+            return None
+        return self._cache.info()
+
+    def precompute(self, origin, target, start, stop, step, tolerance=None):
+        """Create an interpolation table for `target` relative to `origin`
+        from `start` until at least `stop` and use it for later queries.
+
+        The table stores the kernel states at every `step` and interpolates
+        between them with cubic Hermite polynomials. The interpolation error
+        is checked against the kernel halfway between the samples.
+
+        Parameters:
+            origin: :term:`NAIF ID` of the origin.
+            target: :term:`NAIF ID` of the target.
+            start: First Julian date (TDB) to cover.
+            stop: Last Julian date (TDB) to cover.
+            step: Step between samples [days].
+            tolerance: Optional maximum position error [km].
+
+        Returns:
+            The :py:class:`~astrodynamics.lowlevel.tables.InterpolationTable`,
+            which can be saved to skip sampling on the next start.
+
+        Raises:
+            ValueError: If `stop` is before `start`, or the interpolation
+                        error exceeds `tolerance`.
+
+        Example:
+            .. code-block:: python
+
+                table = eph.precompute(0, 399, start, stop, step=0.125,
+                                       tolerance=1e-3)
+                table.save('earth.npz')
+
+                # On the next start:
+                eph.add_table(InterpolationTable.load('earth.npz'))
+        """
+        origin, target = resolve_body(origin), resolve_body(target)
+
+        def compute(tdb, tdb2):
+            r, v = self._compute_states(
+                [(origin, target)], tdb, tdb2, None, None, velocity=True,
+                tables=False)
+            return r[0], v[0]
+
+        table = InterpolationTable.sample(
+            compute, origin, target, start, stop, step, tolerance)
+        self.add_table(table)
+        return table
+
+    def fuse(self, origin, target, start, end):
+        """Fuse the Chebyshev series of the segments on the path from
+        `origin` to `target` into one set of records covering `start` through
+        `end`, and use it for later queries like an interpolation table.
+
+        The records are split at the union of the record boundaries of all
+        segments on the path, and the series of the segments are summed
+        within each record, so that one evaluation replaces a chain of hops.
+        Apart from rounding, the results equal those of the segments.
+
+        Parameters:
+            origin: :term:`NAIF ID` of the origin.
+            target: :term:`NAIF ID` of the target.
+            start: First Julian date (TDB) to cover.
+            end: Last Julian date (TDB) to cover.
+
+        Returns:
+            The :py:class:`~astrodynamics.lowlevel.chebyshev.FusedSegment`.
+
+        Raises:
+            ValueError: If `end` is not after `start`, a segment on the path
+                        is not of SPK type 2 or 3, or the segments do not
+                        cover the time span.
+
+        Example:
+            .. code-block:: python
+
+                # SSB -> EMB -> Earth evaluated as one series.
+                eph.fuse('ssb', 'earth', start, end)
+        """
+        origin, target = resolve_body(origin), resolve_body(target)
+        if end <= start:
+            raise ValueError('end must be after start.')
+        self._open_pending()
+        first = (start - T0) * S_PER_DAY
+        last = (end - T0) * S_PER_DAY
+        breakpoints = [np.array([first, last])]
+        count = 0
+        for key, _ in self._plan(origin, target):
+            coverage = self._coverage[key]
+            overlaps = [
+                i for i, segment in enumerate(coverage.segments)
+                if segment.end_jd >= start and segment.start_jd <= end]
+            if not overlaps:
+                raise ValueError(
+                    'No segment ({}, {}) covers Julian dates {} through {}.'
+                    .format(key[0], key[1], start, end))
+            for i in overlaps:
+                segment = coverage.segments[i]
+                evaluator = coverage.evaluator(i)
+                if not isinstance(evaluator, ChebyshevSegment):
+                    raise ValueError('Only SPK type 2 and 3 segments can be '
+                                     'fused, segment ({}, {}) is of type {}.'
+                                     .format(key[0], key[1], segment.data_type))
+                breakpoints.append(evaluator.starts)
+                breakpoints.append(
+                    [segment.start_second, segment.end_second])
+                count = max(count, evaluator.coefficients.shape[2])
+
+        breakpoints = np.unique(np.concatenate(breakpoints))
+        breakpoints = breakpoints[(breakpoints >= first) & (breakpoints <= last)]
+
+        def compute(tdb, tdb2):
+            r, v = self._compute_states(
+                [(origin, target)], tdb, tdb2, None, None, velocity=True,
+                tables=False)
+            return r[0], v[0]
+
+        fused = FusedSegment.fit(compute, origin, target, breakpoints, count)
+        self.add_table(fused)
+        return fused
+
+    def add_table(self, table):
+        """Serve queries for the pair of bodies of `table` from it, in both
+        directions, replacing any previous table for the pair.
+        """
+        with self._lock:
+            tables = dict(self._tables)
+            tables.pop((table.target, table.origin), None)
+            tables[table.origin, table.target] = table
+            self._set_tables(tables)
+
+    def remove_table(self, origin, target):
+        """Stop serving queries for the pair of bodies from a table."""
+        origin, target = resolve_body(origin), resolve_body(target)
+        with self._lock:
+            tables = dict(self._tables)
+            tables.pop((origin, target), None)
+            tables.pop((target, origin), None)
+            self._set_tables(tables)
+
+    def _set_tables(self, tables):
+        # Replace rather than modify the mapping, which may be in use by
+        # queries in other threads, and likewise the cache.
+        self._tables = tables
+        cache = self._cache
+        if cache is not None:
+            self._cache = cache.cleared()
+
+    @property
+    def tables(self):
+        """Tuple of the interpolation tables and fused segments in use."""
+        return tuple(self._tables.values())
+
+    def _table(self, origin, target, tdb, tdb2):
+        """Return the table covering the epochs for a pair of bodies and the
+        sign to apply, or ``(None, None)``.
+        """
+        tables = self._tables
+        for key, factor in (((origin, target), 1), ((target, origin), -1)):
+            table = tables.get(key)
+            if table is not None and table.covers(tdb, tdb2):
+                return table, factor
+        return None, None
 
     @property
     def kernel(self):
-        _kernel = getattr(self, '_kernel', None)
-        if not _kernel:
+        """The most recently loaded kernel."""
+        self._open_pending()
+        if not self._kernels:
             raise AttributeError("No SPICE kernel was loaded.")
-        else:
-            return self._kernel
-
-    def _compute_segment(self, origin, target, tdb, tdb2):
-        if (target, origin) in self.kernel.pairs:
-            origin, target = target, origin
-            factor = -1
-        elif (origin, target) in self.kernel.pairs:
-            factor = 1
-        segment = self.kernel[origin, target]
-        r, v = segment.compute_and_differentiate(tdb, tdb2)
-        return factor * r, factor * v
-
-    def _compute_path(self, path, tdb, tdb2):
-        if len(path) == 2:
-            r, v = self._compute_segment(path[0], path[1], tdb, tdb2)
-        else:
-            r = np.zeros(3)
-            v = np.zeros(3)
-            for origin, target in zip(path, path[1:]):
-                rs, vs = self._compute_segment(origin, target, tdb, tdb2)
-                r += rs
-                v += vs
-        return r, v
+        return self._kernels[-1]
+
+    @property
+    def kernels(self):
+        """Tuple of loaded kernels, in the order they were loaded."""
+        self._open_pending()
+        return tuple(self._kernels)
+
+    def close(self):
+        """Release the kernels, tables, caches and scratch arrays.
+
+        Kernel files are closed as soon as no other instance uses them, see
+        :py:func:`open_kernel`. Kernels can be loaded again afterwards.
+        """
+        with self._lock:
+            self._kernels = []
+            self._paths = []
+            self._pending = ()
+            self._tables = {}
+            self._build_index()
+            self._local = threading.local()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def prefetch(self, start, end):
+        """Advise the operating system to read the parts of the kernels
+        covering Julian dates `start` through `end` into memory, so that the
+        first queries in this window do not wait for the disk.
 
-    def rv(self, origin, target, tdb, tdb2=0.0):
-        if origin not in self.paths or target not in self.paths:
+        For SPK type 2 and 3 segments only the records covering the window
+        are read, for other segments the whole segment. The pages are read
+        in the background where the platform supports ``madvise`` or
+        ``posix_fadvise``; otherwise this does nothing.
+
+        Returns:
+            Number of bytes advised.
+        """
+        self._open_pending()
+        total = 0
+        for coverage in self._coverage.values():
+            for i, segment in enumerate(coverage.segments):
+                daf = getattr(segment, 'daf', None)
+                overlaps = start <= segment.end_jd and segment.start_jd <= end
+                if daf is None or not overlaps:
+                    continue
+                first, last = _segment_words(
+                    segment, coverage.evaluator(i), start, end)
+                total += _advise(daf, first, last)
+        return total
+
+    def write_subset(self, spk_file, bodies, start, end):
+        """Write a new SPK kernel which only contains the segments needed to
+        compute states between `bodies` from Julian dates `start` through
+        `end` (TDB).
+
+        The segments on the paths between the bodies are cut to the time span
+        by :py:func:`~astrodynamics.lowlevel.spkwriter.cut_segment`. Segments
+        overlapping each other keep their precedence, and the comments of the
+        kernels they come from are kept.
+
+        Parameters:
+            spk_file: File name of the new kernel.
+            bodies: Sequence of bodies, see :py:func:`resolve_body`.
+            start: Julian date (TDB) or :py:class:`~astropy.time.Time`.
+            end: Julian date (TDB) or :py:class:`~astropy.time.Time`.
+
+        Raises:
+            ValueError: If fewer than two bodies are given, no path connects
+                        them, or a segment on it has no coverage in the time
+                        span.
+
+        Example:
+            .. code-block:: python
+
+                with JPLEphemeris() as eph:
+                    eph.load_kernel('de430.bsp')
+                    eph.write_subset('earth_moon.bsp', ['earth', 'moon'],
+                                     2451545.0, 2451545.0 + 365)
+        """
+        start = float(np.sum(_tdb(start, 0.0)))
+        end = float(np.sum(_tdb(end, 0.0)))
+        bodies = [resolve_body(body) for body in bodies]
+        if len(bodies) < 2:
+            raise ValueError('At least two bodies are required.')
+        keys = []
+        for body in bodies[1:]:
+            for key, factor in self._plan(bodies[0], body):
+                if key not in keys:
+                    keys.append(key)
+
+        segments = []
+        comments = []
+        for key in keys:
+            cut = []
+            for segment in self._coverage[key].segments:
+                subset = cut_segment(segment, start, end)
+                if subset is None:
+                    continue
+                cut.append(subset)
+                comment = segment.daf.comments()
+                if comment and comment not in comments:
+                    comments.append(comment)
+            if not cut:
+                raise ValueError(
+                    'No segment for pair ({}, {}) covers the requested epochs.'
+                    .format(*key))
+            segments.extend(cut)
+
+        header = ('Subset of {} for NAIF IDs {} from JD {} to JD {} (TDB).'
+                  .format(', '.join(os.path.basename(str(path))
+                                    for path in self.kernel_paths),
+                          ', '.join(str(body) for body in bodies), start, end))
+        write_spk(spk_file, segments, '\n\n'.join([header] + comments))
+
+    @property
+    def kernel_paths(self):
+        """Tuple of the resolved file names of the loaded kernels, with
+        ``None`` for kernels not loaded from a file.
+        """
+        return self._pending + tuple(self._paths)
+
+    def _find_plan(self, origin, target):
+        self._open_pending()
+        adjacency = self._adjacency
+        if origin not in adjacency or target not in adjacency:
             raise ValueError("Unknown pair({}, {}).".format(origin, target))
-        path = self.paths[origin][target]
-        r, v = self._compute_path(path, tdb, tdb2)
+
+        previous = {origin: None}
+        queue = deque([origin])
+        while queue and target not in previous:
+            body = queue.popleft()
+            for neighbor, key, factor in adjacency[body]:
+                if neighbor not in previous:
+                    previous[neighbor] = (body, key, factor)
+                    queue.append(neighbor)
+
+        if target not in previous:
+            raise ValueError("No path between {} and {}.".format(origin, target))
+
+        plan = []
+        body = target
+        while previous[body] is not None:
+            body, key, factor = previous[body]
+            plan.append((key, factor))
+        return tuple(reversed(plan))
+
+    def _plan(self, origin, target):
+        """Return the hops from `origin` to `target` as a tuple of
+        ``((center, target), factor)`` tuples, where ``(center, target)`` is
+        the segment stored in the kernel and `factor` is -1 if the hop
+        traverses it backwards.
+        """
+        # Plans found while the index is rebuilt go to the replaced cache.
+        plans = self._plans
+        plan = plans.get((origin, target))
+        if plan is None:
+            plan = self._find_plan(origin, target)
+            plans.set((origin, target), plan)
+        return plan
+
+    def path(self, origin, target):
+        """Return the bodies on the shortest path from `origin` to `target`
+        through the segments of the kernel, as a list of :term:`NAIF ID` codes.
+        """
+        origin, target = resolve_body(origin), resolve_body(target)
+        path = [origin]
+        for (center, body), factor in self._plan(origin, target):
+            path.append(body if factor > 0 else center)
+        return path
+
+    def _compute_segment(self, key, tdb, tdb2, r, v, tolerance=None):
+        """Evaluate the segments for `key` into `r` and `v`, which have shape
+        (3, N) for epoch arrays of shape (N,). `v` may be ``None`` to skip
+        the velocity, and `tolerance` the position error per segment.
+        """
+        self._open_pending()
+        coverage = self._coverage[key]
+        workspace = self._workspace
+        winners = coverage.select(tdb + tdb2)
+        if winners.size and np.all(winners == winners.flat[0]):
+            segment = coverage.evaluator(winners.flat[0])
+            segment.evaluate(tdb, tdb2, r, v, workspace, tolerance)
+            return
+
+        for i in np.unique(winners):
+            mask = winners == i
+            count = np.count_nonzero(mask)
+            rs = workspace.empty('segment_r', (3, count))
+            vs = None if v is None else workspace.empty('segment_v', (3, count))
+            segment = coverage.evaluator(i)
+            segment.evaluate(
+                tdb[mask], tdb2[mask], rs, vs, workspace, tolerance)
+            r[:, mask] = rs
+            if v is not None:
+                v[:, mask] = vs
+
+    def _compute(self, pairs, tdb, tdb2, out_r, out_v, velocity,
+                 tolerance=None):
+        pairs = [(resolve_body(origin), resolve_body(target))
+                 for origin, target in pairs]
+        tdb, tdb2 = _tdb(tdb, tdb2)
+        cache = self._cache
+        # Truncated states are not cached, so that they are never returned
+        # for queries at full accuracy.
+        scalar = np.ndim(tdb) == 0 and np.ndim(tdb2) == 0
+        if cache is not None and scalar and tolerance is None:
+            return self._compute_cached(
+                cache, pairs, tdb, tdb2, out_r, out_v, velocity)
+        return self._compute_states(
+            pairs, tdb, tdb2, out_r, out_v, velocity, tolerance=tolerance)
+
+    def _compute_cached(self, cache, pairs, tdb, tdb2, out_r, out_v, velocity):
+        tdb, tdb2 = float(tdb), float(tdb2)
+        r = _output_array(out_r, (len(pairs), 3))
+        v = _output_array(out_v, (len(pairs), 3)) if velocity else None
+
+        missing = []
+        for i, (origin, target) in enumerate(pairs):
+            entry = cache.get((origin, target, tdb, tdb2))
+            # Entries from position-only queries can't serve velocities.
+            if entry is None or (velocity and entry[1] is None):
+                missing.append(i)
+                continue
+            r[i] = entry[0]
+            if velocity:
+                v[i] = entry[1]
+
+        if missing:
+            rs, vs = self._compute_states(
+                [pairs[i] for i in missing], tdb, tdb2, None, None, velocity)
+            for j, i in enumerate(missing):
+                r[i] = rs[j]
+                if velocity:
+                    v[i] = vs[j]
+                origin, target = pairs[i]
+                cache.set((origin, target, tdb, tdb2),
+                          (rs[j].copy(), vs[j].copy() if velocity else None))
         return r, v
+
+    def _compute_states(self, pairs, tdb, tdb2, out_r, out_v, velocity,
+                        tables=True, tolerance=None):
+        tdb, tdb2 = np.broadcast_arrays(tdb, tdb2)
+        shape = (len(pairs), 3) + tdb.shape
+        r = _output_array(out_r, shape)
+        v = _output_array(out_v, shape) if velocity else None
+        workspace = self._workspace
+        n = tdb.size
+        tdb, tdb2 = tdb.ravel(), tdb2.ravel()
+
+        plans = []
+        for i, (origin, target) in enumerate(pairs):
+            table = None
+            if tables and self._tables:
+                table, factor = self._table(origin, target, tdb, tdb2)
+            if table is None:
+                plans.append(self._plan(origin, target))
+                continue
+            plans.append(None)
+            table_r = workspace.empty('table_r', (3, n))
+            table_v = workspace.empty('table_v', (3, n)) if velocity else None
+            table.evaluate(tdb, tdb2, table_r, table_v, workspace)
+            r[i] = table_r.reshape(shape[1:])
+            r[i] *= factor
+            if velocity:
+                v[i] = table_v.reshape(shape[1:])
+                v[i] *= factor
+
+        # Each distinct segment is evaluated once into a row of the state
+        # arrays, however many paths share it.
+        rows = {}
+        for plan in plans:
+            for key, _ in plan or ():
+                rows.setdefault(key, len(rows))
+
+        if tolerance is not None:
+            # Split the tolerance between the hops of the longest path, so
+            # that the errors of its segments add up to at most tolerance.
+            hops = max(len(plan or ()) for plan in plans)
+            tolerance = tolerance / max(hops, 1)
+
+        states_r = workspace.empty('states_r', (len(rows), 3, n))
+        states_v = [None] * len(rows)
+        if velocity:
+            states_v = workspace.empty('states_v', (len(rows), 3, n))
+        for key, row in rows.items():
+            self._compute_segment(
+                key, tdb, tdb2, states_r[row], states_v[row], tolerance)
+
+        states_r = states_r.reshape((len(rows),) + shape[1:])
+        if velocity:
+            states_v = states_v.reshape((len(rows),) + shape[1:])
+        for i, plan in enumerate(plans):
+            if plan is None:
+                continue
+            # Plans from a body to itself have no hops and leave zeros.
+            r[i].fill(0.0)
+            if velocity:
+                v[i].fill(0.0)
+            for key, factor in plan:
+                row = rows[key]
+                if factor > 0:
+                    r[i] += states_r[row]
+                    if velocity:
+                        v[i] += states_v[row]
+                else:
+                    r[i] -= states_r[row]
+                    if velocity:
+                        v[i] -= states_v[row]
+        return r, v
+
+    def rv(self, origin, target, tdb, tdb2=0.0, out_r=None, out_v=None,
+           tolerance=None):
+        """Compute position and velocity of `target` relative to `origin`.
+
+        Parameters:
+            origin: Origin, see :py:func:`resolve_body`.
+            target: Target, see :py:func:`resolve_body`.
+            tdb: Julian date (TDB), scalar or array of shape (N,), or
+                 :py:class:`~astropy.time.Time`.
+            tdb2: Optional second part of the Julian date, scalar or array
+                  which is broadcast against `tdb`. Must be zero if `tdb` is
+                  a :py:class:`~astropy.time.Time`.
+            out_r: Optional array of shape (3,) or (3, N) to write the
+                   position to.
+            out_v: Optional array of shape (3,) or (3, N) to write the
+                   velocity to.
+            tolerance: Optional maximum position error [km], see
+                       :py:meth:`rv_many`.
+
+        Returns:
+            Position [km] and velocity [km/day] arrays with shape (3,) for
+            scalar epochs or (3, N) for epoch arrays.
+        """
+        r, v = self.rv_many(
+            [(origin, target)], tdb, tdb2, _add_axis(out_r), _add_axis(out_v),
+            tolerance)
+        return r[0], v[0]
+
+    def rv_many(self, pairs, tdb, tdb2=0.0, out_r=None, out_v=None,
+                tolerance=None):
+        """Compute positions and velocities for several origin/target pairs.
+
+        The paths of all pairs are merged so that each kernel segment is
+        evaluated once, however many pairs traverse it. For example, the
+        Earth-Moon barycenter segment is shared by queries for the Earth and
+        the Moon relative to the solar system barycenter.
+
+        Parameters:
+            pairs: Sequence of ``(origin, target)`` tuples of bodies, see
+                   :py:func:`resolve_body`.
+            tdb: Julian date (TDB), scalar or array of shape (N,), or
+                 :py:class:`~astropy.time.Time`.
+            tdb2: Optional second part of the Julian date, scalar or array
+                  which is broadcast against `tdb`. Must be zero if `tdb` is
+                  a :py:class:`~astropy.time.Time`.
+            out_r: Optional array of shape (P, 3) or (P, 3, N) to write the
+                   positions to.
+            out_v: Optional array of shape (P, 3) or (P, 3, N) to write the
+                   velocities to.
+            tolerance: Optional maximum position error [km]. Trailing
+                       Chebyshev coefficients of SPK type 2 and 3 segments
+                       are dropped as long as the error stays within it,
+                       which is faster for tolerances well above the
+                       accuracy of the kernel, see
+                       :py:meth:`~astrodynamics.lowlevel.chebyshev.ChebyshevSegment.truncation`.
+                       Velocities are derived from the truncated series and
+                       are not bounded by it. Such queries bypass the state
+                       cache.
+
+        Returns:
+            Position [km] and velocity [km/day] arrays with shape (P, 3) for
+            scalar epochs or (P, 3, N) for epoch arrays, where P is the
+            number of pairs.
+        """
+        return self._compute(
+            pairs, tdb, tdb2, out_r, out_v, velocity=True, tolerance=tolerance)
+
+    def r(self, origin, target, tdb, tdb2=0.0, out=None, tolerance=None):
+        """Compute the position of `target` relative to `origin`.
+
+        Only the position series are evaluated, which is about half the work
+        of :py:meth:`rv`.
+
+        Parameters:
+            origin: Origin, see :py:func:`resolve_body`.
+            target: Target, see :py:func:`resolve_body`.
+            tdb: Julian date (TDB), scalar or array of shape (N,), or
+                 :py:class:`~astropy.time.Time`.
+            tdb2: Optional second part of the Julian date, scalar or array
+                  which is broadcast against `tdb`. Must be zero if `tdb` is
+                  a :py:class:`~astropy.time.Time`.
+            out: Optional array of shape (3,) or (3, N) to write the
+                 position to.
+            tolerance: Optional maximum position error [km], see
+                       :py:meth:`rv_many`.
+
+        Returns:
+            Position [km] array with shape (3,) for scalar epochs or (3, N)
+            for epoch arrays.
+        """
+        r = self.r_many(
+            [(origin, target)], tdb, tdb2, _add_axis(out), tolerance)
+        return r[0]
+
+    def r_many(self, pairs, tdb, tdb2=0.0, out=None, tolerance=None):
+        """Compute positions for several origin/target pairs, sharing
+        segments between their paths like :py:meth:`rv_many`.
+
+        Parameters:
+            out: Optional array of shape (P, 3) or (P, 3, N) to write the
+                 positions to.
+            tolerance: Optional maximum position error [km], see
+                       :py:meth:`rv_many`.
+
+        Returns:
+            Position [km] array with shape (P, 3) for scalar epochs or
+            (P, 3, N) for epoch arrays, where P is the number of pairs.
+        """
+        r, _ = self._compute(
+            pairs, tdb, tdb2, out, None, velocity=False, tolerance=tolerance)
+        return r
+
+    def iter_rv(self, origin, target, start, stop, step, chunk_size=10000):
+        """Generate position and velocity of `target` relative to `origin` in
+        chunks over the epochs ``start, start + step, ...`` up to but not
+        including `stop`.
+
+        The arrays yielded for each chunk are reused for the next one, so
+        memory use is bounded by `chunk_size` however long the time span is.
+        Copy the arrays to keep them beyond the next iteration.
+
+        Parameters:
+            origin: :term:`NAIF ID` of the origin.
+            target: :term:`NAIF ID` of the target.
+            start: First Julian date (TDB).
+            stop: Julian date (TDB) at which to stop.
+            step: Step between epochs [days].
+            chunk_size: Maximum number of epochs per chunk.
+
+        Yields:
+            Tuples ``(tdb, r, v)`` of the epochs with shape (M,) and the
+            position [km] and velocity [km/day] with shape (3, M), where M is
+            at most `chunk_size`.
+
+        Example:
+            .. code-block:: python
+
+                for tdb, r, v in eph.iter_rv(0, 399, start, stop, 1 / 1440):
+                    np.savetxt(f, np.vstack([tdb, r, v]).T)
+        """
+        if step <= 0:
+            raise ValueError('step must be positive.')
+        if chunk_size < 1:
+            raise ValueError('chunk_size must be at least 1.')
+
+        count = max(int(np.ceil((stop - start) / step)), 0)
+        indices = np.arange(min(chunk_size, count))
+        offsets = np.empty(len(indices))
+        tdb = np.empty(len(indices))
+        r = np.empty((3, len(indices)))
+        v = np.empty((3, len(indices)))
+
+        for first in range(0, count, chunk_size):
+            n = min(chunk_size, count - first)
+            # The offsets from `start` are passed as the second part of the
+            # Julian date to retain precision over long time spans.
+            np.add(indices[:n], first, out=offsets[:n])
+            offsets[:n] *= step
+            np.add(offsets[:n], start, out=tdb[:n])
+            self.rv(origin, target, start, offsets[:n],
+                    out_r=r[:, :n], out_v=v[:, :n])
+            yield tdb[:n], r[:, :n], v[:, :n]
+
+    def pairwise(self, bodies, tdb, tdb2=0.0, chunk_size=10000,
+                 out_distance=None, out_range_rate=None):
+        """Compute the distances and range rates between all pairs of
+        `bodies`.
+
+        Each body is evaluated once per epoch relative to the first one,
+        so that kernels without the solar system barycenter can be used too,
+        and the differences of all pairs are formed by
+        broadcasting. The epochs are processed in chunks, which bounds the
+        scratch memory to about ``4 * N * N * chunk_size`` floats.
+
+        Parameters:
+            bodies: Sequence of N bodies, see :py:func:`resolve_body`.
+            tdb: Julian date (TDB), scalar or array of shape (M,), or
+                 :py:class:`~astropy.time.Time`.
+            tdb2: Optional second part of the Julian date, scalar or array
+                  which is broadcast against `tdb`.
+            chunk_size: Maximum number of epochs per chunk.
+            out_distance: Optional array of shape (N, N) or (N, N, M) to
+                          write the distances to, e.g. a
+                          :py:class:`numpy.memmap`.
+            out_range_rate: Optional array of shape (N, N) or (N, N, M) to
+                            write the range rates to.
+
+        Returns:
+            Distance [km] and range rate [km/day] arrays with shape (N, N)
+            for scalar epochs or (N, N, M) for epoch arrays, where the
+            element ``[i, j]`` refers to body `j` as seen from body `i`.
+        """
+        if chunk_size < 1:
+            raise ValueError('chunk_size must be at least 1.')
+        pairs = _relative_to_first(bodies)
+        tdb, tdb2 = np.broadcast_arrays(*_tdb(tdb, tdb2))
+        if tdb.ndim > 1:
+            raise ValueError('Epochs must be scalar or one-dimensional.')
+
+        shape = (len(pairs), len(pairs)) + tdb.shape
+        distance = _output_array(out_distance, shape)
+        range_rate = _output_array(out_range_rate, shape)
+        d, rr = distance, range_rate
+        if tdb.ndim == 0:
+            tdb, tdb2 = tdb[np.newaxis], tdb2[np.newaxis]
+            d, rr = d[..., np.newaxis], rr[..., np.newaxis]
+
+        for first in range(0, len(tdb), chunk_size):
+            chunk = slice(first, first + chunk_size)
+            self._pairwise(
+                pairs, tdb[chunk], tdb2[chunk], d[..., chunk], rr[..., chunk])
+        return distance, range_rate
+
+    def iter_pairwise(self, bodies, start, stop, step, chunk_size=1000):
+        """Generate the distances and range rates between all pairs of
+        `bodies` in chunks over the epochs ``start, start + step, ...`` up to
+        but not including `stop`, like :py:meth:`iter_rv`.
+
+        The arrays yielded for each chunk are reused for the next one.
+
+        Yields:
+            Tuples ``(tdb, distance, range_rate)`` of the epochs with shape
+            (M,) and the distances [km] and range rates [km/day] with shape
+            (N, N, M), where M is at most `chunk_size`.
+        """
+        if step <= 0:
+            raise ValueError('step must be positive.')
+        if chunk_size < 1:
+            raise ValueError('chunk_size must be at least 1.')
+        pairs = _relative_to_first(bodies)
+
+        count = max(int(np.ceil((stop - start) / step)), 0)
+        size = min(chunk_size, count)
+        offsets = np.empty(size)
+        tdb = np.empty(size)
+        distance = np.empty((len(pairs), len(pairs), size))
+        range_rate = np.empty((len(pairs), len(pairs), size))
+
+        for first in range(0, count, chunk_size):
+            n = min(chunk_size, count - first)
+            np.add(np.arange(n), first, out=offsets[:n])
+            offsets[:n] *= step
+            np.add(offsets[:n], start, out=tdb[:n])
+            self._pairwise(pairs, start, offsets[:n], distance[..., :n],
+                           range_rate[..., :n])
+            yield tdb[:n], distance[..., :n], range_rate[..., :n]
+
+    def _pairwise(self, pairs, tdb, tdb2, distance, range_rate):
+        """Write the distances and range rates between the targets of
+        `pairs` for one-dimensional epoch arrays into arrays of shape
+        (N, N, M).
+        """
+        r, v = self.rv_many(pairs, tdb, tdb2)
+        workspace = self._workspace
+        dr = workspace.empty('pairwise_dr', distance.shape)
+        dv = workspace.empty('pairwise_dv', distance.shape)
+        distance.fill(0.0)
+        range_rate.fill(0.0)
+        for k in range(3):
+            np.subtract(r[np.newaxis, :, k], r[:, np.newaxis, k], out=dr)
+            np.subtract(v[np.newaxis, :, k], v[:, np.newaxis, k], out=dv)
+            dv *= dr
+            range_rate += dv
+            dr *= dr
+            distance += dr
+        np.sqrt(distance, out=distance)
+        # The range rate is the projection of the relative velocity on the
+        # line of sight, and zero for a body and itself.
+        np.divide(range_rate, distance, out=range_rate, where=distance > 0)
+
+    def apparent_rv(self, observer, target, tdb, tdb2=0.0, correction='LT'):
+        """Compute the apparent position and velocity of `target` as seen from
+        `observer`, corrected for light time and optionally for stellar
+        aberration.
+
+        See :py:func:`astrodynamics.lowlevel.apparent.apparent_rv`.
+
+        Parameters:
+            correction: ``'LT'``, ``'LT+S'``, ``'CN'`` or ``'CN+S'``.
+
+        Returns:
+            Position [km] and velocity [km/day] arrays with shape (3,) for
+            scalar epochs or (3, N) for epoch arrays, and the light time
+            [days].
+
+        Example:
+            .. code-block:: python
+
+                r, v, lt = eph.apparent_rv(399, 499, tdb, correction='CN+S')
+        """
+        observer, target = resolve_body(observer), resolve_body(target)
+        tdb, tdb2 = _tdb(tdb, tdb2)
+        return apparent_rv(self, observer, target, tdb, tdb2, correction)
+
+    def parallel_rv(self, pairs, start, stop, step, workers=None,
+                    chunk_size=100000):
+        """Compute positions and velocities of several origin/target pairs
+        over the epochs ``start, start + step, ...`` up to but not including
+        `stop` in a pool of worker processes, which write the results into
+        shared memory.
+
+        See :py:func:`astrodynamics.lowlevel.parallel.parallel_rv`, which
+        requires Python 3.8 or later.
+
+        Returns:
+            :py:class:`~astrodynamics.lowlevel.parallel.SharedStates` with
+            epochs of shape (N,) and positions [km] and velocities [km/day]
+            of shape (P, 3, N). Close it to free the shared memory.
+
+        Example:
+            .. code-block:: python
+
+                with eph.parallel_rv([(0, 399), (0, 301)], start, stop,
+                                     1 / 1440) as states:
+                    np.save('earth.npy', states.r[0])
+        """
+        from .parallel import parallel_rv
+        pairs = [(resolve_body(origin), resolve_body(target))
+                 for origin, target in pairs]
+        return parallel_rv(self, pairs, start, stop, step, workers, chunk_size)
+
+
+class _SegmentAdapter(object):
+    """Provide the ``evaluate`` method of
+    :py:class:`~astrodynamics.lowlevel.chebyshev.ChebyshevSegment` for
+    segments evaluated by :py:mod:`jplephem`.
+    """
+    def __init__(self, segment):
+        self.segment = segment
+
+    def evaluate(self, tdb, tdb2, r, v=None, workspace=None, tolerance=None):
+        if v is None:
+            # Type 3 segments from jplephem return velocity components as well.
+            r[...] = self.segment.compute(tdb, tdb2)[:3]
+        else:
+            r[...], v[...] = self.segment.compute_and_differentiate(tdb, tdb2)
+
+
+def _relative_to_first(bodies):
+    """Return pairs of the first of `bodies` and each of them."""
+    targets = [resolve_body(body) for body in bodies]
+    return [(targets[0], target) for target in targets]
+
+
+def _segment_words(segment, evaluator, start, end):
+    """Return the first and last word of `segment` covering Julian dates
+    `start` through `end`.
+    """
+    if not isinstance(evaluator, ChebyshevSegment):
+        return segment.start_i, segment.end_i
+    seconds = (np.array([start, end]) - T0) * S_PER_DAY
+    first, last = np.searchsorted(evaluator.starts, seconds, 'right') - 1
+    count, rsize = evaluator.records.shape
+    first = min(max(first, 0), count - 1)
+    last = min(max(last, 0), count - 1)
+    return (segment.start_i + first * rsize,
+            segment.start_i + (last + 1) * rsize - 1)
+
+
+def _advise(daf, first, last):
+    """Advise the operating system to read words `first` through `last` of
+    `daf`, returning the number of bytes advised.
+    """
+    offset = 8 * (first - 1)
+    length = 8 * (last - first + 1)
+    # DAF.map_array maps the whole file, wrapped in a memoryview on Python 3.
+    mapping = getattr(daf._map, 'obj', daf._map)
+    if isinstance(mapping, mmap.mmap) and hasattr(mmap, 'MADV_WILLNEED'):
+        aligned = offset - offset % mmap.PAGESIZE
+        length = min(length + offset - aligned, len(mapping) - aligned)
+        mapping.madvise(mmap.MADV_WILLNEED, aligned, length)
+    elif hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(
+            daf.file.fileno(), offset, length, os.POSIX_FADV_WILLNEED)
+    else:
+        return 0
+    return length
+
+
+def _tdb(tdb, tdb2):
+    """Return the two parts of the Julian dates (TDB) of `tdb` and `tdb2`,
+    converting :py:class:`~astropy.time.Time` objects.
+    """
+    if not isinstance(tdb, Time):
+        return tdb, tdb2
+    if np.any(np.asarray(tdb2) != 0):
+        raise ValueError('tdb2 must be zero if tdb is a Time.')
+
+    global _last_time
+    ref, jd1, jd2 = _last_time
+    if ref is None or ref() is not tdb:
+        # Converted for the whole array at once, keeping both parts.
+        converted = tdb.tdb
+        jd1, jd2 = converted.jd1, converted.jd2
+        _last_time = (weakref.ref(tdb), jd1, jd2)
+    return jd1, jd2
+
+
+def _output_array(out, shape):
+    if out is None:
+        return np.empty(shape)
+    if out.shape != shape:
+        raise ValueError('Output array has shape {}, expected {}.'
+                         .format(out.shape, shape))
+    return out
+
+
+def _add_axis(out):
+    return None if out is None else out[np.newaxis]
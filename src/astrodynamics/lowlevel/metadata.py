@@ -0,0 +1,110 @@
+# coding: utf-8
+"""The astrodynamics.lowlevel.metadata module
+
+This module keeps the segment summaries of SPK kernels in JSON sidecar
+files, so that opening a kernel again does not read and parse all of its
+summary records.
+"""
+from __future__ import absolute_import, division, print_function
+
+import hashlib
+import json
+import os
+
+import jplephem.spk as spk
+from jplephem.daf import DAF
+
+from ..utils import suppress_file_exists_error
+
+__all__ = (
+    'open_spk',
+)
+
+VERSION = 1
+
+
+def open_spk(path, metadata_dir):
+    """Open the SPK kernel at `path`, taking its segment summaries from the
+    metadata cache in `metadata_dir` if they are up to date.
+
+    Cached summaries are used as long as the size and modification time of
+    the kernel file are unchanged. Otherwise, the kernel is parsed and the
+    cache is updated. Failing to write the cache is not an error.
+
+    Parameters:
+        path: File name of the kernel.
+        metadata_dir: Directory of the metadata cache, for example
+                      :py:const:`~astrodynamics.utils.SPK_METADATA_DIR`.
+
+    Returns:
+        :py:class:`jplephem.spk.SPK`
+    """
+    path = os.path.realpath(path)
+    stat = os.stat(path)
+    identity = {'path': path, 'size': stat.st_size, 'mtime': stat.st_mtime}
+    name = hashlib.sha1(path.encode('utf-8')).hexdigest() + '.json'
+    sidecar = os.path.join(str(metadata_dir), name)
+
+    summaries = _read(sidecar, identity)
+    if summaries is None:
+        kernel = spk.SPK.open(path)
+        _write(sidecar, identity, kernel)
+        return kernel
+
+    f = open(path, 'rb')
+    try:
+        daf = DAF(f)
+    except Exception:
+        f.close()
+        raise
+    # Equivalent to spk.SPK.__init__, with the summaries from the cache. Older
+    # jplephem versions construct all segments as Segment.
+    build_segment = getattr(spk, 'build_segment', spk.Segment)
+    kernel = spk.SPK.__new__(spk.SPK)
+    kernel.daf = daf
+    kernel.segments = [
+        build_segment(daf, source.encode('latin-1'), tuple(descriptor))
+        for source, descriptor in summaries]
+    kernel.pairs = dict(((s.center, s.target), s) for s in kernel.segments)
+    return kernel
+
+
+def _read(sidecar, identity):
+    """Return the cached summaries, or ``None`` if they are missing or out of
+    date.
+    """
+    try:
+        with open(sidecar, 'r') as f:
+            metadata = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    if metadata.get('version') != VERSION or metadata.get('file') != identity:
+        return None
+    return metadata['summaries']
+
+
+def _write(sidecar, identity, kernel):
+    summaries = [
+        (segment.source.decode('latin-1'),
+         (segment.start_second, segment.end_second, segment.target,
+          segment.center, segment.frame, segment.data_type, segment.start_i,
+          segment.end_i))
+        for segment in kernel.segments]
+    metadata = {'version': VERSION, 'file': identity, 'summaries': summaries}
+
+    # Write to a temporary file first, so that concurrent readers never see
+    # a partial file.
+    temporary = '{}.{}.tmp'.format(sidecar, os.getpid())
+    try:
+        with suppress_file_exists_error():
+            os.makedirs(os.path.dirname(sidecar))
+        with open(temporary, 'w') as f:
+            json.dump(metadata, f)
+        if os.name == 'nt' and os.path.exists(sidecar):
+            os.remove(sidecar)
+        os.rename(temporary, sidecar)
+    except (IOError, OSError):
+        try:
+            os.remove(temporary)
+        except OSError:
+            pass
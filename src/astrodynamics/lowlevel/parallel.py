@@ -0,0 +1,155 @@
+# coding: utf-8
+"""The astrodynamics.lowlevel.parallel module
+
+This module evaluates ephemerides for large grids of epochs in a pool of
+worker processes, which write their results directly into shared memory.
+
+It requires Python 3.8 or later for :py:mod:`multiprocessing.shared_memory`.
+"""
+from __future__ import absolute_import, division, print_function
+
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+__all__ = (
+    'SharedStates',
+    'parallel_rv',
+)
+
+# Ephemeris of the worker process, created once by _initialize.
+_ephemeris = None
+
+
+class SharedStates(object):
+    """Positions and velocities in shared memory, as returned by
+    :py:func:`parallel_rv`.
+
+    The arrays are views of the shared memory blocks. :py:meth:`close` frees
+    the blocks once no views of them are left, so copy the arrays to keep
+    them beyond it.
+
+    Attributes:
+        tdb: Epochs, array of shape (N,).
+        r: Positions [km], array of shape (P, 3, N).
+        v: Velocities [km/day], array of shape (P, 3, N).
+    """
+    def __init__(self, shape):
+        size = max(int(np.prod(shape)), 1) * np.dtype(np.float64).itemsize
+        self._blocks = []
+        self._blocks.append(shared_memory.SharedMemory(create=True, size=size))
+        self._blocks.append(shared_memory.SharedMemory(create=True, size=size))
+        self.shape = shape
+        self.r = np.ndarray(shape, buffer=self._blocks[0].buf)
+        self.v = np.ndarray(shape, buffer=self._blocks[1].buf)
+        self.tdb = None
+
+    @property
+    def names(self):
+        """Names of the shared memory blocks for positions and velocities."""
+        return tuple(block.name for block in self._blocks)
+
+    def close(self):
+        """Release the arrays and free the shared memory."""
+        self.tdb = self.r = self.v = None
+        for block in self._blocks:
+            block.unlink()
+            try:
+                block.close()
+            except BufferError:
+                # Views are still in use, the memory is released with them.
+                pass
+        self._blocks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def parallel_rv(ephemeris, pairs, start, stop, step, workers=None,
+                chunk_size=100000):
+    """Compute positions and velocities of several origin/target pairs over
+    the epochs ``start, start + step, ...`` up to but not including `stop` in
+    a pool of worker processes.
+
+    Each worker opens the kernels of `ephemeris` from their files, which are
+    memory mapped and so shared with the other processes by the operating
+    system, and writes its chunks of epochs straight into shared memory. Only
+    the file names and the chunk bounds are sent to the workers. Caches and
+    interpolation tables of `ephemeris` are not used.
+
+    Parameters:
+        ephemeris: :py:class:`~astrodynamics.lowlevel.ephemerides.JPLEphemeris`
+                   with kernels loaded from files.
+        pairs: Sequence of ``(origin, target)`` :term:`NAIF ID` tuples.
+        start: First Julian date (TDB).
+        stop: Julian date (TDB) at which to stop.
+        step: Step between epochs [days].
+        workers: Number of worker processes, by default the number of CPUs.
+        chunk_size: Maximum number of epochs per task.
+
+    Returns:
+        :py:class:`SharedStates`, which must be closed to free the memory.
+
+    Raises:
+        ValueError: If a kernel was not loaded from a file.
+    """
+    if step <= 0:
+        raise ValueError('step must be positive.')
+    if chunk_size < 1:
+        raise ValueError('chunk_size must be at least 1.')
+    paths = ephemeris.kernel_paths
+    if None in paths:
+        raise ValueError('Only kernels loaded from files can be opened by '
+                         'worker processes.')
+
+    pairs = [tuple(pair) for pair in pairs]
+    for origin, target in pairs:
+        # Fail early for unknown pairs.
+        ephemeris.path(origin, target)
+
+    count = max(int(np.ceil((stop - start) / step)), 0)
+    states = SharedStates((len(pairs), 3, count))
+    try:
+        states.tdb = start + step * np.arange(count)
+        chunks = range(0, count, chunk_size)
+        with ProcessPoolExecutor(workers, initializer=_initialize,
+                                 initargs=(paths,)) as executor:
+            tasks = [
+                executor.submit(_evaluate, states.names, states.shape, pairs,
+                                start, step, first, min(first + chunk_size, count))
+                for first in chunks]
+            for task in tasks:
+                task.result()
+    except BaseException:
+        states.close()
+        raise
+    return states
+
+
+def _initialize(paths):
+    from .ephemerides import JPLEphemeris
+
+    global _ephemeris
+    _ephemeris = JPLEphemeris()
+    for path in paths:
+        _ephemeris.load_kernel(path)
+
+
+def _evaluate(names, shape, pairs, start, step, first, last):
+    blocks = [shared_memory.SharedMemory(name=name) for name in names]
+    r, v = [np.ndarray(shape, buffer=block.buf) for block in blocks]
+    try:
+        # The offsets from `start` are passed as the second part of the
+        # Julian date to retain precision, as in JPLEphemeris.iter_rv.
+        offsets = step * np.arange(first, last)
+        _ephemeris.rv_many(pairs, start, offsets, out_r=r[..., first:last],
+                           out_v=v[..., first:last])
+    finally:
+        # The views must be gone before the blocks can be closed.
+        del r, v
+        for block in blocks:
+            block.close()
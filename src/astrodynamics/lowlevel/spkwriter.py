@@ -0,0 +1,387 @@
+# coding: utf-8
+"""The astrodynamics.lowlevel.spkwriter module
+
+This module writes SPK kernels, for example subsets of loaded kernels which
+only contain the segments and time spans a job needs, or Chebyshev fits of
+sampled trajectories.
+"""
+from __future__ import absolute_import, division, print_function
+
+import struct
+
+import numpy as np
+
+from .chebyshev import S_PER_DAY, T0
+
+__all__ = (
+    'SPKSegment',
+    'cut_segment',
+    'fit_chebyshev',
+    'write_spk',
+)
+
+FTPSTR = b'FTPSTR:\r:\n:\r\n:\r\x00:\x81:\x10\xce:ENDFTP'
+
+RECORD_BYTES = 1024
+RECORD_WORDS = RECORD_BYTES // 8
+# SPK summaries have ND = 2 double precision and NI = 6 integer components.
+SUMMARY_FORMAT = '<2d6i'
+SUMMARY_STEP = struct.calcsize(SUMMARY_FORMAT)
+NAME_LENGTH = 40
+SUMMARIES_PER_RECORD = (RECORD_BYTES - 24) // SUMMARY_STEP
+COMMENT_BYTES = 1000
+
+# Number of words written to the file at once.
+_CHUNK_WORDS = 1 << 20
+
+# Number of samples whose normal equations are accumulated at once.
+_CHUNK_SAMPLES = 1 << 14
+
+
+class SPKSegment(object):
+    """Segment to be written by :py:func:`write_spk`.
+
+    Parameters:
+        center: :term:`NAIF ID` of the center.
+        target: :term:`NAIF ID` of the target.
+        frame: Reference frame code, e.g. 1 for J2000.
+        data_type: SPK data type.
+        start_second: Start of the coverage in seconds past J2000 (TDB).
+        end_second: End of the coverage in seconds past J2000 (TDB).
+        data: Sequence of arrays, which are written one after another as the
+              data of the segment.
+        name: Segment name of at most 40 characters.
+    """
+    def __init__(self, center, target, frame, data_type, start_second,
+                 end_second, data, name=''):
+        self.center = center
+        self.target = target
+        self.frame = frame
+        self.data_type = data_type
+        self.start_second = start_second
+        self.end_second = end_second
+        self.data = [np.asarray(array, dtype=float).ravel() for array in data]
+        self.name = name
+
+    @property
+    def start_jd(self):
+        return T0 + self.start_second / S_PER_DAY
+
+    @property
+    def end_jd(self):
+        return T0 + self.end_second / S_PER_DAY
+
+    def __len__(self):
+        return sum(len(array) for array in self.data)
+
+
+def cut_segment(segment, start_jd, end_jd):
+    """Cut a segment of a loaded kernel to the Julian dates `start_jd` through
+    `end_jd` (TDB).
+
+    The coverage of the new segment is the overlap of both. For SPK type 2
+    and 3 segments only the records covering the overlap are kept, other
+    segments keep all of their data. No data is copied: the returned segment
+    refers to the memory map of the kernel.
+
+    Parameters:
+        segment: :py:class:`jplephem.spk.Segment`
+        start_jd: Julian date (TDB) at which to start.
+        end_jd: Julian date (TDB) at which to end.
+
+    Returns:
+        :py:class:`SPKSegment`, or ``None`` if `segment` does not overlap the
+        time span.
+    """
+    start = max(segment.start_second, (start_jd - T0) * S_PER_DAY)
+    end = min(segment.end_second, (end_jd - T0) * S_PER_DAY)
+    if start > end:
+        return None
+
+    daf = segment.daf
+    if segment.data_type in (2, 3):
+        init, intlen, rsize, n = daf.read_array(segment.end_i - 3, segment.end_i)
+        rsize = int(rsize)
+        n = int(n)
+        records = daf.map_array(segment.start_i, segment.end_i - 4)
+        records = records.reshape((n, rsize))
+        first, last = np.clip(
+            np.floor((np.array([start, end]) - init) / intlen).astype(int),
+            0, n - 1)
+        data = [records[first:last + 1],
+                [init + first * intlen, intlen, rsize, last + 1 - first]]
+    else:
+        data = [daf.map_array(segment.start_i, segment.end_i)]
+
+    name = segment.source.decode('latin-1')
+    return SPKSegment(segment.center, segment.target, segment.frame,
+                      segment.data_type, start, end, data, name)
+
+
+def write_spk(path, segments, comment='', name='astrodynamics'):
+    """Write `segments` to a new little-endian SPK kernel at `path`.
+
+    As in the :term:`SPICE toolkit`, segments later in the sequence take
+    precedence where they overlap earlier ones for the same pair of bodies.
+
+    Parameters:
+        path: File name of the kernel.
+        segments: Sequence of :py:class:`SPKSegment`.
+        comment: Text for the comment area of the kernel.
+        name: Internal file name of at most 60 characters.
+
+    Raises:
+        ValueError: If `comment` or a name is not ASCII.
+    """
+    segments = list(segments)
+    comment = comment.replace('\n', '\0').encode('ascii') + b'\x04'
+    comment_records = -(-len(comment) // COMMENT_BYTES) if len(comment) > 1 else 0
+    summary_records = max(-(-len(segments) // SUMMARIES_PER_RECORD), 1)
+
+    # Layout: file record, comment records, pairs of summary and name
+    # records, then the segment data.
+    fward = 2 + comment_records
+    bward = fward + 2 * (summary_records - 1)
+    address = (bward + 1) * RECORD_WORDS + 1
+    descriptors = []
+    for segment in segments:
+        descriptors.append((address, address + len(segment) - 1))
+        address += len(segment)
+
+    file_record = struct.pack(
+        '<8sII60sIII8s603s28s297s', b'DAF/SPK ', 2, 6,
+        name.encode('ascii').ljust(60), fward, bward, address, b'LTL-IEEE',
+        b'\0' * 603, FTPSTR, b'\0' * 297)
+
+    with open(str(path), 'wb') as f:
+        f.write(file_record)
+        for i in range(comment_records):
+            chunk = comment[i * COMMENT_BYTES:(i + 1) * COMMENT_BYTES]
+            f.write(chunk.ljust(RECORD_BYTES, b'\0'))
+
+        for i in range(summary_records):
+            first = i * SUMMARIES_PER_RECORD
+            chunk = range(first, min(first + SUMMARIES_PER_RECORD, len(segments)))
+            record = fward + 2 * i
+            summaries = [struct.pack(
+                '<3d', record + 2 if record < bward else 0,
+                record - 2 if i else 0, len(chunk))]
+            names = []
+            for j in chunk:
+                segment = segments[j]
+                summaries.append(struct.pack(
+                    SUMMARY_FORMAT, segment.start_second, segment.end_second,
+                    segment.target, segment.center, segment.frame,
+                    segment.data_type, *descriptors[j]))
+                names.append(segment.name.encode('ascii')[:NAME_LENGTH]
+                             .ljust(NAME_LENGTH))
+            f.write(b''.join(summaries).ljust(RECORD_BYTES, b'\0'))
+            f.write(b''.join(names).ljust(RECORD_BYTES, b' '))
+
+        for segment in segments:
+            for array in segment.data:
+                for i in range(0, len(array), _CHUNK_WORDS):
+                    chunk = array[i:i + _CHUNK_WORDS]
+                    f.write(chunk.astype('<f8', copy=False).tobytes())
+
+
+def fit_chebyshev(center, target, tdb, r, v=None, tolerance=1e-3, degree=12,
+                  data_type=2, frame=1, name=''):
+    """Fit an SPK type 2 or 3 segment to sampled states, for example of a
+    propagated trajectory.
+
+    The samples are split into records of equal length, as required by the
+    SPK format, and each record is fitted by linear least squares, for all
+    records at once. The record length is chosen adaptively: the number of
+    records is doubled until the positions of the fit are within `tolerance`
+    of all samples, and then reduced to the smallest number that still is.
+
+    If velocities are given, they are fitted together with the positions.
+    Each record needs at least twice as many samples as it has coefficients
+    for the fit to be determined between the samples, which limits the
+    number of records.
+
+    Parameters:
+        center: :term:`NAIF ID` of the center.
+        target: :term:`NAIF ID` of the target.
+        tdb: Julian dates (TDB) of the samples in ascending order, array of
+             shape (N,).
+        r: Positions [km], array of shape (3, N).
+        v: Optional velocities [km/day], array of shape (3, N). Required for
+           type 3 segments.
+        tolerance: Maximum position error [km] at the samples, as the
+                   distance between the fitted and the sampled positions.
+        degree: Degree of the Chebyshev series of each record.
+        data_type: 2 to fit positions only, their derivative providing the
+                   velocity, or 3 to fit separate series for the velocity.
+        frame: Reference frame code, e.g. 1 for J2000.
+        name: Segment name of at most 40 characters.
+
+    Returns:
+        :py:class:`SPKSegment` covering the first through the last sample.
+
+    Raises:
+        ValueError: If the samples are invalid, or the tolerance cannot be met.
+
+    Example:
+        .. code-block:: python
+
+            segment = fit_chebyshev(399, -1000, tdb, r, v, tolerance=1e-4)
+            write_spk('trajectory.bsp', [segment])
+    """
+    if data_type not in (2, 3):
+        raise ValueError('Only SPK data types 2 and 3 are supported.')
+    if data_type == 3 and v is None:
+        raise ValueError('Type 3 segments require velocities.')
+    tdb = np.asarray(tdb, dtype=float)
+    r = np.asarray(r, dtype=float)
+    if v is not None:
+        v = np.asarray(v, dtype=float)
+    if tdb.ndim != 1 or r.shape != (3, len(tdb)):
+        raise ValueError('Expected epochs of shape (N,) and states of shape '
+                         '(3, N).')
+    if np.any(np.diff(tdb) <= 0):
+        raise ValueError('Epochs must be strictly increasing.')
+
+    # Equations per sample and coefficients per record and component.
+    equations = 1 if v is None else 2
+    count = degree + 1
+    t = tdb - tdb[0]
+    span = t[-1]
+    if span <= 0 or equations * len(t) < 2 * count:
+        raise ValueError('Not enough samples for a series of degree {}.'
+                         .format(degree))
+
+    def fit(n):
+        """Return the coefficients for `n` records if they meet the tolerance
+        and determine the series, otherwise ``None``.
+        """
+        index = np.minimum((t * (n / span)).astype(int), n - 1)
+        counts = np.bincount(index, minlength=n)
+        if np.any(equations * counts < 2 * count):
+            return None
+        coefficients, error = _fit_records(
+            t, index, counts, span / n, r, v, count)
+        if error > tolerance:
+            return None
+        return coefficients
+
+    # Double the number of records until the tolerance is met, then bisect.
+    n = 1
+    coefficients = fit(n)
+    while coefficients is None:
+        n *= 2
+        if equations * len(t) < 2 * count * n:
+            raise ValueError(
+                'Tolerance {} km cannot be met with series of degree {}.'
+                .format(tolerance, degree))
+        coefficients = fit(n)
+    low = n // 2
+    while n - low > 1:
+        middle = (low + n) // 2
+        candidate = fit(middle)
+        if candidate is None:
+            low = middle
+        else:
+            n, coefficients = middle, candidate
+
+    if data_type == 2:
+        coefficients = coefficients[:, :3]
+    else:
+        # Type 3 velocities are in km/s.
+        coefficients[:, 3:] /= S_PER_DAY
+
+    start = (tdb[0] - T0) * S_PER_DAY
+    end = (tdb[-1] - T0) * S_PER_DAY
+    intlen = span * S_PER_DAY / n
+    # The records must reach the last sample despite rounding, as readers
+    # reject epochs past the end of the last record.
+    while start + intlen * n < end:
+        intlen = np.nextafter(intlen, np.inf)
+    records = np.empty((n, 2 + coefficients[0].size))
+    records[:, 0] = start + intlen * (np.arange(n) + 0.5)
+    records[:, 1] = intlen / 2
+    records[:, 2:] = coefficients.reshape((n, -1))
+    trailer = [start, intlen, records.shape[1], n]
+    return SPKSegment(center, target, frame, data_type, start, end,
+                      [records, trailer], name)
+
+
+def _normalized_time(t, index, intlen):
+    """Return the times `t` [days] normalised to [-1, 1] within their records."""
+    return 2 * (t - intlen * index) / intlen - 1
+
+
+def _chebyshev_basis(s, count):
+    """Return the Chebyshev polynomials and their derivatives of degree 0
+    through ``count - 1`` at `s`, as arrays of shape (N, count).
+    """
+    basis = np.empty((count, len(s)))
+    derivatives = np.empty((count, len(s)))
+    basis[0] = 1
+    derivatives[0] = 0
+    if count > 1:
+        basis[1] = s
+        derivatives[1] = 1
+    for k in range(2, count):
+        basis[k] = 2 * s * basis[k - 1] - basis[k - 2]
+        derivatives[k] = 2 * (basis[k - 1] + s * derivatives[k - 1])
+        derivatives[k] -= derivatives[k - 2]
+    return basis.T, derivatives.T
+
+
+def _fit_records(t, index, counts, intlen, r, v, count):
+    """Fit all records by least squares.
+
+    The samples of a block of records are padded with zeros to the same
+    number per record, so that the normal equations of the whole block are
+    batched matrix products.
+
+    Returns:
+        Coefficients of shape (n, 3, count) for the positions, or (n, 6,
+        count) if velocities are given: the first three components fitted to
+        both positions and velocities, the last three to the velocities
+        alone. Also returns the largest distance between the fitted and
+        the sampled positions.
+    """
+    n = len(counts)
+    coefficients = np.empty((n, 3 if v is None else 6, count))
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    width = counts.max()
+    step = max(_CHUNK_SAMPLES // width, 1)
+    error = 0.0
+    for first in range(0, n, step):
+        last = min(first + step, n)
+        samples = slice(offsets[first], offsets[last])
+        records = index[samples]
+        rows = np.arange(samples.start, samples.stop) - offsets[records]
+
+        def pad(values):
+            padded = np.zeros((last - first, width, values.shape[1]))
+            padded[records - first, rows] = values
+            return padded
+
+        basis, derivatives = _chebyshev_basis(
+            _normalized_time(t[samples], records, intlen), count)
+        basis = pad(basis)
+        transposed = basis.swapaxes(1, 2)
+        positions = pad(r[:, samples].T)
+        normal = np.matmul(transposed, basis)
+        right = np.matmul(transposed, positions)
+        if v is not None:
+            velocities = pad(v[:, samples].T)
+            coefficients[first:last, 3:] = np.linalg.solve(
+                normal, np.matmul(transposed, velocities)).swapaxes(1, 2)
+            # Velocity equations scaled from km/day to km per unit of the
+            # normalised time, to be weighted like the positions.
+            derivatives = pad(derivatives)
+            transposed = derivatives.swapaxes(1, 2)
+            normal = normal + np.matmul(transposed, derivatives)
+            right += np.matmul(transposed, velocities * (intlen / 2))
+
+        solution = np.linalg.solve(normal, right)
+        coefficients[first:last, :3] = solution.swapaxes(1, 2)
+        # The padding has no error, as its rows are zero on both sides.
+        residuals = np.matmul(basis, solution) - positions
+        error = max(error, np.sqrt(np.max(np.sum(residuals ** 2, axis=-1))))
+    return coefficients, error
@@ -0,0 +1,192 @@
+# coding: utf-8
+"""The astrodynamics.lowlevel.tables module
+
+This module contains interpolation tables, which serve states of frequently
+queried pairs of bodies from samples at a fixed step instead of evaluating
+the kernel segments.
+"""
+from __future__ import absolute_import, division, print_function
+
+import numpy as np
+
+__all__ = (
+    'InterpolationTable',
+)
+
+
+class InterpolationTable(object):
+    """Cubic Hermite interpolation table of the state of `target` relative to
+    `origin`, sampled at a fixed step.
+
+    Since the samples are equally spaced, the interval of an epoch is found
+    by index arithmetic instead of a search.
+
+    Parameters:
+        origin: :term:`NAIF ID` of the origin.
+        target: :term:`NAIF ID` of the target.
+        start: Julian date (TDB) of the first sample.
+        step: Step between samples [days].
+        positions: Array of shape (3, n) with the sampled positions [km].
+        velocities: Array of shape (3, n) with the sampled velocities
+                    [km/day].
+        max_error: Maximum position error [km] measured by
+                   :py:meth:`sample`, if known.
+    """
+    def __init__(self, origin, target, start, step, positions, velocities,
+                 max_error=None):
+        positions = np.asarray(positions, dtype=float)
+        velocities = np.asarray(velocities, dtype=float)
+        if positions.ndim != 2 or positions.shape[0] != 3 or positions.shape[1] < 2:
+            raise ValueError('positions must have shape (3, n) with n >= 2.')
+        if velocities.shape != positions.shape:
+            raise ValueError('velocities must have the shape of positions.')
+        if step <= 0:
+            raise ValueError('step must be positive.')
+
+        self.origin = origin
+        self.target = target
+        self.start = start
+        self.step = step
+        self.positions = positions
+        self.velocities = velocities
+        self.max_error = max_error
+
+    @property
+    def stop(self):
+        """Julian date (TDB) of the last sample."""
+        return self.start + self.step * (self.positions.shape[1] - 1)
+
+    @classmethod
+    def sample(cls, compute, origin, target, start, stop, step, tolerance=None):
+        """Create a table by sampling `compute` from `start` until at least
+        `stop`.
+
+        The interpolation error is measured against `compute` halfway
+        between samples, where the error of cubic Hermite interpolation is
+        largest, and stored as :py:attr:`max_error`.
+
+        Parameters:
+            compute: Function of the two parts of the Julian date arrays
+                     returning position [km] and velocity [km/day] arrays of
+                     shape (3, N).
+            origin: :term:`NAIF ID` of the origin.
+            target: :term:`NAIF ID` of the target.
+            start: First Julian date (TDB) to cover.
+            stop: Last Julian date (TDB) to cover.
+            step: Step between samples [days].
+            tolerance: Optional maximum position error [km].
+
+        Raises:
+            ValueError: If `stop` is before `start`, or the error exceeds
+                        `tolerance`.
+        """
+        if step <= 0:
+            raise ValueError('step must be positive.')
+        if stop < start:
+            raise ValueError('stop must not be before start.')
+        count = max(int(np.ceil((stop - start) / step)), 1) + 1
+        offsets = step * np.arange(count)
+        positions, velocities = compute(start, offsets)
+        table = cls(origin, target, start, step, positions, velocities)
+
+        midpoints = offsets[:-1] + step / 2
+        expected, _ = compute(start, midpoints)
+        r = np.empty_like(expected)
+        table.evaluate(start, midpoints, r)
+        table.max_error = np.sqrt(np.max(np.sum((r - expected) ** 2, axis=0)))
+
+        if tolerance is not None and table.max_error > tolerance:
+            raise ValueError(
+                'Interpolation error of {} km exceeds the tolerance of {} km, '
+                'use a smaller step.'.format(table.max_error, tolerance))
+        return table
+
+    def _steps(self, tdb, tdb2):
+        """Return the epochs in units of steps since the first sample."""
+        # Subtract the start first to retain precision.
+        return ((np.asarray(tdb) - self.start) + tdb2) / self.step
+
+    def covers(self, tdb, tdb2=0.0):
+        """Return whether all epochs `tdb` plus `tdb2` lie within the table."""
+        x = self._steps(tdb, tdb2)
+        return bool(np.all(x >= 0) and np.all(x <= self.positions.shape[1] - 1))
+
+    def evaluate(self, tdb, tdb2, r, v=None, workspace=None):
+        """Interpolate the state for one-dimensional epoch arrays, writing the
+        results into existing arrays.
+
+        Parameters:
+            tdb: Julian date (TDB), scalar or array of shape (N,).
+            tdb2: Second part of the Julian date, broadcast against `tdb`.
+            r: Output array of shape (3, N) for the position [km].
+            v: Optional output array of shape (3, N) for the velocity
+               [km/day].
+            workspace: Unused, for compatibility with
+                       :py:class:`~astrodynamics.lowlevel.chebyshev.FusedSegment`.
+
+        Raises:
+            ValueError: If an epoch lies outside of the table.
+        """
+        x = self._steps(tdb, tdb2)
+        last = self.positions.shape[1] - 1
+        if np.any(x < 0) or np.any(x > last):
+            raise ValueError(
+                'Table ({}, {}) only covers Julian dates {} through {}.'
+                .format(self.origin, self.target, self.start, self.stop))
+
+        # Epochs on the last sample use the last interval.
+        index = np.minimum(x.astype(np.intp), last - 1)
+        u = x - index
+        u2 = u * u
+        p0 = self.positions[:, index]
+        dp = self.positions[:, index + 1] - p0
+        v0 = self.velocities[:, index]
+        v1 = self.velocities[:, index + 1]
+
+        # Hermite basis functions, with h01 = 1 - h00.
+        h01 = u2 * (3 - 2 * u)
+        h10 = u2 * u - 2 * u2 + u
+        h11 = u2 * u - u2
+        r[...] = p0 + h01 * dp + self.step * (h10 * v0 + h11 * v1)
+        if v is not None:
+            d01 = 6 * (u - u2)
+            d10 = 3 * u2 - 4 * u + 1
+            d11 = 3 * u2 - 2 * u
+            v[...] = d01 * dp / self.step + d10 * v0 + d11 * v1
+
+    def compute_and_differentiate(self, tdb, tdb2=0.0):
+        """Interpolate position and velocity for epochs `tdb` plus `tdb2`.
+
+        Returns:
+            Position [km] and velocity [km/day] arrays of shape (3,) for
+            scalar epochs, or (3, ...) for epoch arrays.
+        """
+        tdb, tdb2 = np.broadcast_arrays(tdb, tdb2)
+        r = np.empty((3,) + tdb.shape)
+        v = np.empty((3,) + tdb.shape)
+        self.evaluate(tdb.ravel(), tdb2.ravel(),
+                      r.reshape((3, -1)), v.reshape((3, -1)))
+        return r, v
+
+    def save(self, file):
+        """Save the table to an uncompressed ``.npz`` file of ``.npy``
+        arrays, which :py:meth:`load` reads back without sampling again.
+
+        Parameters:
+            file: File name or file object. A ``.npz`` extension is appended
+                  to file names without it, like :py:func:`numpy.savez`.
+        """
+        max_error = np.nan if self.max_error is None else self.max_error
+        np.savez(file, origin=self.origin, target=self.target,
+                 start=self.start, step=self.step, positions=self.positions,
+                 velocities=self.velocities, max_error=max_error)
+
+    @classmethod
+    def load(cls, file):
+        """Load a table saved with :py:meth:`save`."""
+        with np.load(file) as data:
+            max_error = float(data['max_error'])
+            return cls(
+                int(data['origin']), int(data['target']), float(data['start']),
+                float(data['step']), data['positions'], data['velocities'],
+                None if np.isnan(max_error) else max_error)
@@ -13,6 +13,7 @@ from .helper import (
 from .progress import DownloadProgressBar, DownloadProgressSpinner
 from .web import (
     SPK_DIR,
+    SPK_METADATA_DIR,
     SPK_OLD_URL,
     SPK_URL,
     InvalidCategoryError,
@@ -37,6 +38,7 @@ __all__ = (
     'qisclose',
     'read_only_property',
     'SPK_DIR',
+    'SPK_METADATA_DIR',
     'SPK_OLD_URL',
     'SPK_URL',
     'SPKDownloadError',
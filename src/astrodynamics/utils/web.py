@@ -18,6 +18,7 @@ SPK_OLD_URL = ("http://naif.jpl.nasa.gov/pub/naif/generic_kernels/"
 
 appdirs = AppDirs('astrodynamics')
 SPK_DIR = Path(appdirs.user_data_dir, 'spk')
+SPK_METADATA_DIR = Path(appdirs.user_data_dir, 'spk_metadata')
 
 
 class SPKDownloadError(Exception):
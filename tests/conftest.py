@@ -0,0 +1,79 @@
+# coding: utf-8
+from __future__ import absolute_import, division, print_function
+
+import numpy as np
+import pytest
+
+from astrodynamics.lowlevel.ephemerides import JPLEphemeris
+from astrodynamics.lowlevel.spkwriter import write_spk
+
+from .spkfile import ChebyshevData
+
+
+class MockSegment(object):
+    def __init__(self, center, target, value, start_jd=-np.inf,
+                 end_jd=np.inf, calls=None):
+        self.center = center
+        self.target = target
+        self.value = value
+        self.start_jd = start_jd
+        self.end_jd = end_jd
+        self.calls = calls if calls is not None else []
+
+    def compute_and_differentiate(self, tdb, tdb2):
+        self.calls.append((self.center, self.target))
+        r = np.full((3,) + np.shape(tdb), self.value)
+        v = np.full((3,) + np.shape(tdb), self.value)
+        return r, v
+
+    def compute(self, tdb, tdb2):
+        self.calls.append((self.center, self.target))
+        return np.full((3,) + np.shape(tdb), self.value)
+
+
+class MockKernel(object):
+    def __init__(self, segments=None):
+        self.calls = []
+        if segments is None:
+            segments = [
+                (0, 3, 3.0),
+                (0, 4, 4.0),
+                (3, 301, 2.0),
+                (3, 399, 1.0),
+            ]
+        self.segments = [MockSegment(*args, calls=self.calls)
+                         for args in segments]
+
+
+@pytest.fixture
+def ephemeris():
+    """Ephemeris of a :py:class:`MockKernel`. Test modules which need real
+    kernels override it.
+    """
+    eph = JPLEphemeris()
+    eph._add_kernel(MockKernel())
+    return eph
+
+
+@pytest.fixture
+def write_kernel(tmpdir):
+    """Return a function which writes segments to a kernel in `tmpdir` and
+    returns its path.
+    """
+    def write(segments, name='test.bsp'):
+        path = str(tmpdir.join(name))
+        write_spk(path, segments)
+        return path
+    return write
+
+
+@pytest.fixture
+def spk_path(request, write_kernel):
+    """Path of a kernel of random Chebyshev series, laid out by the
+    ``SEGMENTS`` of the test module as ``(center, target, init, intlen,
+    shape)`` tuples, see :py:class:`~tests.spkfile.ChebyshevData`.
+    """
+    rng = np.random.RandomState(0)
+    return write_kernel([
+        ChebyshevData(center, target, init, intlen, rng.uniform(-1, 1, shape))
+        for center, target, init, intlen, shape in request.module.SEGMENTS])
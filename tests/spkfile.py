@@ -0,0 +1,28 @@
+# coding: utf-8
+"""Helpers to create small SPK segments for tests."""
+from __future__ import absolute_import, division, print_function
+
+import numpy as np
+
+from astrodynamics.lowlevel.chebyshev import S_PER_DAY, T0
+from astrodynamics.lowlevel.spkwriter import SPKSegment
+
+
+class ChebyshevData(SPKSegment):
+    """Type 2 or 3 segment with `coefficients` of shape (n, components,
+    coefficient_count), starting at `init` Julian date with records of
+    `intlen` days.
+    """
+    def __init__(self, center, target, init, intlen, coefficients, frame=1):
+        coefficients = np.asarray(coefficients, dtype=float)
+        n, components, count = coefficients.shape
+        self.init = (init - T0) * S_PER_DAY
+        self.intlen = intlen * S_PER_DAY
+        records = np.empty((n, 2 + components * count))
+        records[:, 0] = self.init + self.intlen * (np.arange(n) + 0.5)
+        records[:, 1] = self.intlen / 2
+        records[:, 2:] = coefficients.reshape((n, -1))
+        trailer = [self.init, self.intlen, records.shape[1], n]
+        super(ChebyshevData, self).__init__(
+            center, target, frame, 2 if components == 3 else 3, self.init,
+            self.init + self.intlen * n, [records, trailer], name='test')
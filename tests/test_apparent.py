@@ -0,0 +1,95 @@
+# coding: utf-8
+from __future__ import absolute_import, division, print_function
+
+import numpy as np
+import pytest
+
+from astrodynamics.lowlevel.apparent import (
+    SPEED_OF_LIGHT, apparent_rv, stellar_aberration)
+from astrodynamics.lowlevel.ephemerides import JPLEphemeris
+
+from .conftest import MockKernel
+
+T = 2451545.0
+W = np.array([1e6, 2e6, 0.0])  # km/day
+
+
+class LinearEphemeris(object):
+    """Observer 1 resting at the barycenter and target 2 moving from it with
+    constant velocity `W` since `T`.
+    """
+    def __init__(self):
+        self.sizes = []
+
+    def rv(self, origin, target, tdb, tdb2=0.0):
+        t = (np.asarray(tdb) - T) + tdb2
+        self.sizes.append(np.size(t))
+        if target == 1:
+            return np.zeros((3,) + t.shape), np.zeros((3,) + t.shape)
+        v = np.multiply.outer(W, np.ones_like(t))
+        return v * t, v
+
+
+def test_converged_light_time():
+    eph = LinearEphemeris()
+    t = np.array([1e-6, 1.0, 1e4])
+    r, v, lt = apparent_rv(eph, 1, 2, T, t, correction='CN')
+
+    speed = np.linalg.norm(W)
+    lt_expected = speed * t / (SPEED_OF_LIGHT + speed)
+    np.testing.assert_allclose(lt, lt_expected, rtol=1e-12, atol=1e-16)
+    # Within the tolerance of the light time iteration.
+    np.testing.assert_allclose(
+        r, np.outer(W, t - lt_expected), rtol=1e-12, atol=speed * 1e-13)
+    np.testing.assert_allclose(
+        v, np.outer(W, np.ones(3)) * SPEED_OF_LIGHT / (SPEED_OF_LIGHT + speed),
+        rtol=1e-12)
+
+    # Converged epochs are not evaluated again.
+    iterations = eph.sizes[2:]
+    assert iterations[0] == 3
+    assert iterations == sorted(iterations, reverse=True)
+    assert iterations[-1] < 3
+
+
+def test_single_iteration():
+    eph = LinearEphemeris()
+    r, v, lt = apparent_rv(eph, 1, 2, T, 1e4, correction='lt')
+    assert r.shape == v.shape == (3,)
+    assert np.ndim(lt) == 0
+    assert eph.sizes == [1, 1, 1]
+
+    speed = np.linalg.norm(W)
+    lt0 = speed * 1e4 / SPEED_OF_LIGHT
+    np.testing.assert_allclose(r, W * (1e4 - lt0), rtol=1e-12)
+    np.testing.assert_allclose(lt, np.linalg.norm(r) / SPEED_OF_LIGHT)
+
+    with pytest.raises(ValueError):
+        apparent_rv(eph, 1, 2, T, correction='XLT')
+
+
+def test_stellar_aberration():
+    beta = 1e-4
+    r = np.array([[2.0, 0.0], [0.0, 0.0], [0.0, 3.0]])
+    v = np.array([[0.0, 0.0], [beta, 0.0], [0.0, 1.0]]) * SPEED_OF_LIGHT
+    corrected = stellar_aberration(r, v)
+    angle = np.arcsin(beta)
+    np.testing.assert_allclose(
+        corrected[:, 0], 2 * np.array([np.cos(angle), np.sin(angle), 0.0]))
+    # No aberration along the velocity.
+    np.testing.assert_allclose(corrected[:, 1], r[:, 1])
+
+
+def test_ephemeris_apparent_rv():
+    eph = JPLEphemeris()
+    eph._add_kernel(MockKernel())
+    tdb = np.linspace(T, T + 1, 4)
+    r, v, lt = eph.apparent_rv(399, 301, tdb, correction='CN+S')
+    assert r.shape == v.shape == (3, 4)
+    r_expected, v_expected, lt_expected = apparent_rv(
+        eph, 399, 301, tdb, correction='CN+S')
+    assert np.all(r == r_expected)
+    assert np.all(v == v_expected)
+    assert np.all(lt == lt_expected)
+    # The mock states don't change with time.
+    np.testing.assert_allclose(r, eph.rv(399, 301, tdb)[0], rtol=1e-9)
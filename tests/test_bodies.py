@@ -49,6 +49,7 @@ def test_celestial_body():
     b = CelestialBody.from_reference_ellipsoid(name='earth', ellipsoid=wgs84,
                                                naif_id=399)
     assert a.mu == b.mu == wgs84.mu
+    assert a.naif_id == b.naif_id == 399
 
     ellipsoid = Ellipsoid(a=1 * u.m, b=1 * u.m)
     c = CelestialBody(name='earth', ellipsoid=ellipsoid,
@@ -0,0 +1,121 @@
+# coding: utf-8
+from __future__ import absolute_import, division, print_function
+
+import threading
+
+import numpy as np
+import pytest
+
+from astrodynamics.lowlevel.cache import LRUCache, Workspace
+
+
+def test_lru_eviction():
+    cache = LRUCache(maxsize=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    assert len(cache) == 2
+    assert 'a' in cache
+    assert 'b' not in cache
+    assert cache.get('b') is None
+    assert cache.get('b', 0) == 0
+    assert cache.items() == [('a', 1), ('c', 3)]
+
+
+def test_lru_unbounded():
+    cache = LRUCache(maxsize=None)
+    for i in range(1000):
+        cache.set(i, i)
+    assert len(cache) == 1000
+    cache.clear()
+    assert len(cache) == 0
+
+
+def test_lru_disabled():
+    cache = LRUCache(maxsize=0)
+    cache.set('a', 1)
+    assert 'a' not in cache
+
+
+def test_lru_invalid_size():
+    with pytest.raises(ValueError):
+        LRUCache(maxsize=-1)
+    with pytest.raises(ValueError):
+        LRUCache(maxbytes=-1)
+
+
+def test_lru_maxbytes():
+    cache = LRUCache(maxsize=None, maxbytes=100)
+    cache.set('a', np.zeros(5))
+    cache.set('b', (np.zeros(3), np.zeros(2)))
+    assert cache.nbytes == 80
+    cache.set('c', np.zeros(3))
+    assert 'a' not in cache
+    assert cache.nbytes == 64
+    # Entries larger than the whole cache are not stored.
+    cache.set('d', np.zeros(20))
+    assert 'd' not in cache
+    assert len(cache) == 2
+
+
+def test_lru_info():
+    cache = LRUCache(maxsize=2)
+    cache.set('a', 1)
+    cache.get('a')
+    cache.get('b')
+    cache.get('a')
+    info = cache.info()
+    assert (info.hits, info.misses, info.currsize) == (2, 1, 1)
+    assert info.maxsize == 2
+    cache.clear()
+    assert cache.info().hits == 2
+
+
+def test_lru_cleared():
+    cache = LRUCache(maxsize=2, maxbytes=100)
+    cache.set('a', np.zeros(2))
+    cache.get('a')
+    cache.get('b')
+    fresh = cache.cleared()
+    assert fresh is not cache
+    assert len(fresh) == 0
+    assert 'a' in cache
+    assert fresh.info() == (1, 1, 2, 0, 100, 0)
+
+
+def test_lru_threads():
+    cache = LRUCache(maxsize=50, maxbytes=4000)
+
+    def run(offset):
+        for i in range(2000):
+            cache.set((offset + i) % 97, np.zeros(i % 10))
+            cache.get((offset + i) % 89)
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    info = cache.info()
+    assert info.hits + info.misses == 8000
+    assert info.currsize <= 50
+    assert info.nbytes == sum(size for _, size in cache._data.values())
+
+
+def test_workspace_reuses_buffers():
+    workspace = Workspace()
+    a = workspace.empty('a', (3, 10))
+    assert a.shape == (3, 10)
+    b = workspace.empty('a', (2, 5))
+    assert np.shares_memory(a, b)
+    c = workspace.empty('a', (3, 20))
+    assert not np.shares_memory(a, c)
+    assert not np.shares_memory(c, workspace.empty('b', (3, 20)))
+    assert not np.shares_memory(c, workspace.empty('a', (3,), dtype=int))
+
+    z = workspace.zeros('a', (4, 4))
+    assert np.all(z == 0)
+
+    workspace.clear()
+    assert not np.shares_memory(c, workspace.empty('a', (3, 20)))
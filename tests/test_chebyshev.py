@@ -0,0 +1,224 @@
+# coding: utf-8
+from __future__ import absolute_import, division, print_function
+
+import numpy as np
+import pytest
+from jplephem.spk import SPK
+
+from astrodynamics.lowlevel.chebyshev import (
+    ChebyshevSegment, FusedSegment, S_PER_DAY)
+from astrodynamics.lowlevel.ephemerides import JPLEphemeris
+from astrodynamics.lowlevel.spkwriter import write_spk
+
+from .spkfile import ChebyshevData
+
+
+SEGMENTS = [
+    (0, 3, 2451545.0, 16.0, (20, 3, 11)),
+    (3, 399, 2451545.0, 4.0, (80, 3, 13)),
+    (3, 301, 2451545.0, 4.0, (80, 6, 7)),
+]
+
+
+@pytest.fixture
+def kernel(spk_path):
+    with SPK.open(spk_path) as kernel:
+        yield kernel
+
+
+def test_type2_matches_jplephem(kernel):
+    segment = kernel[0, 3]
+    evaluator = ChebyshevSegment(segment)
+    tdb = np.linspace(segment.start_jd, segment.end_jd, 1001)
+
+    r, v = evaluator.compute_and_differentiate(tdb)
+    r_expected, v_expected = segment.compute_and_differentiate(tdb)
+    assert r.shape == v.shape == (3, 1001)
+    np.testing.assert_allclose(r, r_expected, rtol=0, atol=1e-12)
+    np.testing.assert_allclose(v, v_expected, rtol=0, atol=1e-12)
+
+    r, v = evaluator.compute_and_differentiate(2451550.0, 0.25)
+    r_expected, v_expected = segment.compute_and_differentiate(2451550.0, 0.25)
+    assert r.shape == v.shape == (3,)
+    np.testing.assert_allclose(r, r_expected, rtol=0, atol=1e-12)
+    np.testing.assert_allclose(v, v_expected, rtol=0, atol=1e-12)
+
+
+def test_type3_matches_jplephem(kernel):
+    segment = kernel[3, 301]
+    evaluator = ChebyshevSegment(segment)
+    tdb = np.linspace(segment.start_jd, segment.end_jd, 1001)
+
+    r, v = evaluator.compute_and_differentiate(tdb)
+    expected = segment.compute(tdb)
+    np.testing.assert_allclose(r, expected[:3], rtol=0, atol=1e-12)
+    np.testing.assert_allclose(v, expected[3:] * S_PER_DAY, rtol=0, atol=1e-7)
+
+
+def test_position_only(kernel):
+    for key in [(0, 3), (3, 301)]:
+        segment = kernel[key]
+        evaluator = ChebyshevSegment(segment)
+        tdb = np.linspace(segment.start_jd, segment.end_jd, 101)
+        r = evaluator.compute(tdb)
+        assert r.shape == (3, 101)
+        np.testing.assert_allclose(
+            r, segment.compute(tdb)[:3], rtol=0, atol=1e-12)
+        assert evaluator.compute(tdb[0]).shape == (3,)
+
+
+def test_out_of_range(kernel):
+    evaluator = ChebyshevSegment(kernel[0, 3])
+    with pytest.raises(ValueError):
+        evaluator.compute_and_differentiate(2451544.0)
+    with pytest.raises(ValueError):
+        evaluator.compute_and_differentiate([2451546.0, 2451545.0 + 321])
+
+
+def test_segment_end(tmpdir):
+    rng = np.random.RandomState(5)
+    coefficients = rng.uniform(-1, 1, (4, 3, 5))
+    segment = ChebyshevData(0, 3, 2451545.0, 1.0, coefficients)
+    # The declared end lies slightly past the end of the last record, like
+    # segments fitted to samples.
+    end = segment.end_second = segment.end_second + 1.2e-7
+    path = str(tmpdir.join('end.bsp'))
+    write_spk(path, [segment])
+
+    with SPK.open(path) as kernel:
+        segment = kernel.segments[0]
+        evaluator = ChebyshevSegment(segment)
+        tdb = [segment.start_jd, segment.end_jd, 2451549.0]
+        r, v = evaluator.compute_and_differentiate(tdb)
+        r_expected, v_expected = segment.compute_and_differentiate(tdb)
+        np.testing.assert_allclose(r, r_expected, rtol=0, atol=1e-12)
+        np.testing.assert_allclose(v, v_expected, rtol=0, atol=1e-12)
+        assert list(evaluator._index(np.array([0.0, end, 4 * S_PER_DAY]))) \
+            == [0, 3, 3]
+        with pytest.raises(ValueError):
+            evaluator.compute(segment.end_jd + 1e-6)
+
+
+def test_unsupported_type(kernel):
+    segment = kernel[0, 3]
+    segment.data_type = 9
+    with pytest.raises(ValueError):
+        ChebyshevSegment(segment)
+
+
+def test_ephemeris_uses_native_engine(spk_path, kernel):
+    eph = JPLEphemeris()
+    eph.load_kernel(spk_path)
+    tdb = np.linspace(2451545.0, 2451545.0 + 320, 501)
+
+    r, v = eph.rv(0, 399, tdb)
+    r1, v1 = kernel[0, 3].compute_and_differentiate(tdb)
+    r2, v2 = kernel[3, 399].compute_and_differentiate(tdb)
+    np.testing.assert_allclose(r, r1 + r2, rtol=0, atol=1e-12)
+    np.testing.assert_allclose(v, v1 + v2, rtol=0, atol=1e-12)
+    assert isinstance(eph._coverage[0, 3].evaluator(0), ChebyshevSegment)
+
+
+def test_fuse(tmpdir):
+    rng = np.random.RandomState(7)
+    path = str(tmpdir.join('fuse.bsp'))
+    write_spk(path, [
+        ChebyshevData(0, 3, 2451545.0, 16.0, rng.uniform(-1, 1, (20, 3, 11))),
+        # Records not aligned with those of the first segment.
+        ChebyshevData(3, 301, 2451546.3, 5.0, rng.uniform(-1, 1, (60, 6, 7))),
+    ])
+    eph = JPLEphemeris()
+    eph.load_kernel(path)
+    start, end = 2451550.5, 2451600.0
+    tdb = np.linspace(start, end, 777)
+    r_expected, v_expected = eph.rv(301, 0, tdb)
+
+    fused = eph.fuse('moon', 'ssb', start, end)
+    assert eph.tables == (fused,)
+    # Boundaries of both segments within the window.
+    assert len(fused.breakpoints) == 1 + 3 + 10 + 1
+    assert fused.coefficients.shape == (14, 6, 11)
+    np.testing.assert_allclose((fused.start, fused.stop), (start, end))
+
+    r, v = eph.rv(301, 0, tdb)
+    np.testing.assert_allclose(r, r_expected, rtol=1e-11, atol=1e-9)
+    np.testing.assert_allclose(v, v_expected, rtol=1e-11, atol=1e-9)
+    # Served in reverse, too.
+    r = eph.r(0, 301, tdb)
+    np.testing.assert_allclose(r, -r_expected, rtol=1e-11, atol=1e-9)
+
+    # Fused queries use the scratch arrays of the ephemeris.
+    buffers = dict(eph._workspace._buffers)
+    assert ('fused_records', np.dtype(float)) in buffers
+    eph.rv(301, 0, tdb[:100])
+    for key, buffer in buffers.items():
+        assert eph._workspace._buffers[key] is buffer
+
+    # Queries outside fall back to the kernel.
+    assert not fused.covers(end + 1)
+    eph.rv(301, 0, end + 1)
+    with pytest.raises(ValueError):
+        eph.fuse(301, 0, start, 2451545.0 + 400)
+    eph.close()
+
+
+def test_fuse_invalid_window(spk_path):
+    eph = JPLEphemeris()
+    eph.load_kernel(spk_path)
+    tdb = 2451550.0
+    expected = eph.rv(0, 399, tdb)
+    with pytest.raises(ValueError):
+        eph.fuse(0, 399, tdb, tdb)
+    with pytest.raises(ValueError):
+        eph.fuse(0, 399, tdb, tdb - 1)
+    # No segment overlaps the window.
+    with pytest.raises(ValueError):
+        eph.fuse(0, 399, 2451545.0 + 400, 2451545.0 + 401)
+    assert eph.tables == ()
+    r, v = eph.rv(0, 399, tdb)
+    assert np.all(r == expected[0]) and np.all(v == expected[1])
+    eph.close()
+
+    with pytest.raises(ValueError):
+        FusedSegment(0, 399, [0.0], np.zeros((0, 6, 3)))
+    with pytest.raises(ValueError):
+        FusedSegment(0, 399, [0.0, 1.0], np.zeros((1, 6, 0)))
+
+
+def test_truncation(tmpdir):
+    rng = np.random.RandomState(8)
+    decay = 1e4 * 10.0 ** -np.arange(13)
+    path = str(tmpdir.join('decay.bsp'))
+    write_spk(path, [
+        ChebyshevData(0, 3, 2451545.0, 16.0,
+                      rng.uniform(-1, 1, (20, 3, 13)) * decay),
+        ChebyshevData(3, 399, 2451545.0, 4.0,
+                      rng.uniform(-1, 1, (80, 3, 13)) * decay),
+    ])
+    eph = JPLEphemeris(cache_size=10)
+    eph.load_kernel(path)
+    evaluator = eph._coverage[0, 3].evaluator(0)
+
+    counts = evaluator.truncation(1.0)
+    assert counts.shape == (20,)
+    assert np.all((counts >= 4) & (counts <= 6))
+    assert evaluator.tails.shape == (20, 13)
+    assert evaluator.tails is evaluator.tails
+    assert np.all(evaluator.truncation(1.0, [3, 1, 3]) == counts[[3, 1, 3]])
+    assert np.all(evaluator.truncation(0.0) == 13)
+    assert np.all(evaluator.truncation(1e6) == 1)
+
+    tdb = np.linspace(2451545.0, 2451545.0 + 320, 2001)
+    r_exact, v_exact = eph.rv(0, 399, tdb)
+    for tolerance in [1e-6, 1e-2, 1.0, 100.0]:
+        r, v = eph.rv(0, 399, tdb, tolerance=tolerance)
+        error = np.linalg.norm(r - r_exact, axis=0)
+        assert np.max(error) <= tolerance
+        assert np.max(error) > 0
+        assert np.all(eph.r(0, 399, tdb, tolerance=tolerance) == r)
+
+    # Truncated states are not cached.
+    r = eph.r(0, 399, tdb[1], tolerance=100.0)
+    assert np.all(eph.r(0, 399, tdb[1]) == r_exact[:, 1])
+    assert eph.cache_info().currsize == 1
+    eph.close()
@@ -0,0 +1,83 @@
+# coding: utf-8
+from __future__ import absolute_import, division, print_function
+
+import numpy as np
+import pytest
+from jplephem.spk import SPK
+
+from astrodynamics.lowlevel.discrete import DiscreteSegment
+from astrodynamics.lowlevel.ephemerides import JPLEphemeris
+from astrodynamics.lowlevel.spkwriter import SPKSegment
+
+T = 2451545.0
+
+
+def trajectory(seconds):
+    """Cubic positions [km] and their derivatives [km/s]."""
+    t = seconds / 1e4
+    r = np.array([t ** 3 - t, 2 * t ** 2 + 1, 5 - t ** 3])
+    v = np.array([3 * t ** 2 - 1, 4 * t, -3 * t ** 2]) / 1e4
+    return r, v
+
+
+def discrete_segment(data_type, seconds, window, target=-1000):
+    r, v = trajectory(seconds)
+    states = np.concatenate([r, v]).T
+    directory = seconds[99:-1:100]
+    trailer = [window - 1, len(seconds)]
+    return SPKSegment(399, target, 1, data_type, seconds[0], seconds[-1],
+                      [states, seconds, directory, trailer])
+
+
+@pytest.fixture
+def spk_path(write_kernel):
+    rng = np.random.RandomState(3)
+    # Irregular epochs with several directory entries.
+    seconds = np.cumsum(rng.uniform(10, 100, 350))
+    path = write_kernel([
+        discrete_segment(9, seconds, 5, -1000),
+        discrete_segment(9, seconds, 4, -1001),
+        discrete_segment(13, seconds, 2, -1002),
+        discrete_segment(13, seconds, 3, -1003),
+    ])
+    return path, seconds
+
+
+@pytest.mark.parametrize('target', [-1000, -1001, -1002, -1003])
+def test_discrete_segment(spk_path, target):
+    path, seconds = spk_path
+    eph = JPLEphemeris()
+    eph.load_kernel(path)
+    # Including the first and last epoch and the directory epochs.
+    t = np.concatenate([
+        np.linspace(seconds[0], seconds[-1], 1001), seconds[99::100]])
+    tdb = T + t / 86400
+
+    # The second part of the Julian date retains the precision of t.
+    r, v = eph.rv(399, target, T, t / 86400)
+    r_expected, v_expected = trajectory(t)
+    np.testing.assert_allclose(r, r_expected, rtol=1e-9, atol=1e-9)
+    np.testing.assert_allclose(v, v_expected * 86400, rtol=1e-9, atol=1e-9)
+
+    evaluator = eph._coverage[399, target].evaluator(0)
+    assert isinstance(evaluator, DiscreteSegment)
+    np.testing.assert_allclose(
+        evaluator.compute(tdb[1]), r[:, 1], rtol=1e-6)
+    with pytest.raises(ValueError):
+        eph.rv(399, target, T)
+    eph.close()
+
+
+def test_window(write_kernel):
+    kernel = SPK.open(write_kernel([discrete_segment(9, np.arange(250.0), 4)]))
+    evaluator = DiscreteSegment(kernel.segments[0])
+
+    t = np.array([0.0, 0.5, 1.0, 99.5, 100.0, 150.2, 249.0])
+    # Two epochs before and after, shifted at the ends.
+    assert list(evaluator._window(t)) == [0, 0, 0, 98, 98, 149, 246]
+    evaluator.window = 5
+    # Centred on the nearest epoch.
+    assert list(evaluator._window(t)) == [0, 0, 0, 97, 98, 148, 245]
+    # Epochs converging after different numbers of steps.
+    assert list(evaluator._window(np.array([10.3, 249.0005]))) == [8, 245]
+    kernel.close()
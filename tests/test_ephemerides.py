@@ -1,54 +1,24 @@
 # coding: utf-8
 from __future__ import absolute_import, division, print_function
 
+import gc
+import os
+import pickle
+import threading
+
 import numpy as np
 import pytest
+from astropy.time import Time
 
 import astrodynamics.lowlevel.ephemerides as ephemerides
+from astrodynamics.bodies import earth
 
+from .conftest import MockKernel
 
-class MockSegment(object):
-    def __init__(self, a, b):
-        self.a = a
-        self.b = b
-
-    def compute_and_differentiate(self, tdb, tdb2):
-        r = np.empty(3)
-        v = np.empty(3)
-        if self.a == 3 and self.b == 399:
-            r.fill(1.0)
-            v.fill(1.0)
-        elif self.a == 3 and self.b == 301:
-            r.fill(2.0)
-            v.fill(2.0)
-        elif self.a == 0 and self.b == 3:
-            r.fill(3.0)
-            v.fill(3.0)
-        elif self.a == 0 and self.b == 4:
-            r.fill(4.0)
-            v.fill(4.0)
-        return r, v
-
-
-class MockKernel(object):
-    def __init__(self):
-        self.pairs = [
-            (0, 3),
-            (0, 4),
-            (3, 301),
-            (3, 399),
-        ]
-
-    def __getitem__(self, ind):
-        return MockSegment(ind[0], ind[1])
-
-
-@pytest.fixture
-def ephemeris():
-    eph = ephemerides.JPLEphemeris()
-    eph._kernel = MockKernel()
-    eph.generate_paths()
-    return eph
+SEGMENTS = [
+    (0, 3, 2451545.0, 16.0, (4, 3, 5)),
+    (3, 399, 2451545.0, 4.0, (16, 3, 5)),
+]
 
 
 def test_pair_failure(ephemeris):
@@ -56,6 +26,65 @@ def test_pair_failure(ephemeris):
         ephemeris.rv(0, 5, 0)
 
 
+def test_disconnected_pair_failure(ephemeris):
+    ephemeris._add_kernel(MockKernel([(10, 199, 1.0)]))
+    with pytest.raises(ValueError):
+        ephemeris.rv(0, 199, 0)
+
+
+def test_path(ephemeris):
+    assert ephemeris.path(0, 3) == [0, 3]
+    assert ephemeris.path(301, 0) == [301, 3, 0]
+    assert ephemeris.path(399, 4) == [399, 3, 0, 4]
+    assert ephemeris.path(399, 399) == [399]
+
+    r, v = ephemeris.rv(399, 399, 0)
+    assert np.all(r == 0.0)
+    assert np.all(v == 0.0)
+
+
+def test_same_body(ephemeris):
+    tdb = np.array([2451545.0, 2451546.0, 2451547.0])
+    r, v = ephemeris.rv(399, 399, tdb, 0.25)
+    assert r.shape == v.shape == (3, 3)
+    assert np.all(r == 0.0) and np.all(v == 0.0)
+    assert np.all(ephemeris.r(0, 0, 2451545.0, tdb - 2451545.0) == 0.0)
+
+    r, v = ephemeris.rv_many([(3, 399), (301, 301)], tdb)
+    assert r.shape == v.shape == (2, 3, 3)
+    assert np.all(r[0] == 1.0)
+    assert np.all(r[1] == 0.0) and np.all(v[1] == 0.0)
+
+    ephemeris.enable_cache()
+    for _ in range(2):
+        assert np.all(ephemeris.rv(4, 4, 2451545.0)[1] == np.zeros(3))
+
+
+def test_plan_cache():
+    eph = ephemerides.JPLEphemeris(plan_cache_size=2)
+    eph._add_kernel(MockKernel())
+    eph.rv(0, 399, 0)
+    eph.rv(0, 301, 0)
+    eph.rv(0, 4, 0)
+    assert len(eph._plans) == 2
+    assert (0, 399) not in eph._plans
+    assert (0, 4) in eph._plans
+
+    eph._build_index()
+    assert len(eph._plans) == 0
+
+    # Plans found while the index is rebuilt are not kept.
+    find_plan = eph._find_plan
+
+    def rebuild_and_find(origin, target):
+        eph._build_index()
+        return find_plan(origin, target)
+
+    eph._find_plan = rebuild_and_find
+    eph.rv(0, 399, 0)
+    assert len(eph._plans) == 0
+
+
 def test_ephemeris(ephemeris):
     r, v = ephemeris.rv(0, 3, 0)
     assert np.all(r == 3.0)
@@ -108,3 +137,425 @@ def test_ephemeris(ephemeris):
     r, v = ephemeris.rv(4, 301, 0, 0)
     assert np.all(r == 1.0)
     assert np.all(v == 1.0)
+
+
+def test_ephemeris_vectorized(ephemeris):
+    tdb = np.linspace(2451545.0, 2451546.0, 5)
+    r, v = ephemeris.rv(0, 301, tdb)
+    assert r.shape == v.shape == (3, 5)
+    assert np.all(r == 5.0)
+    assert np.all(v == 5.0)
+    r, v = ephemeris.rv(4, 301, tdb)
+    assert r.shape == v.shape == (3, 5)
+    assert np.all(r == 1.0)
+    assert np.all(v == 1.0)
+    r, v = ephemeris.rv(399, 0, 2451545.0, np.zeros(4))
+    assert r.shape == v.shape == (3, 4)
+    assert np.all(r == -4.0)
+    assert np.all(v == -4.0)
+    r, v = ephemeris.rv(0, 399, 2451545.0)
+    assert r.shape == v.shape == (3,)
+
+
+def test_rv_many(ephemeris):
+    pairs = [(0, 399), (0, 301), (301, 0), (0, 4), (4, 399)]
+    tdb = np.linspace(2451545.0, 2451546.0, 5)
+    r, v = ephemeris.rv_many(pairs, tdb)
+    assert r.shape == v.shape == (5, 3, 5)
+    for (origin, target), rp, vp in zip(pairs, r, v):
+        re, ve = ephemeris.rv(origin, target, tdb)
+        assert np.all(rp == re)
+        assert np.all(vp == ve)
+
+    # Each segment is evaluated once, however many paths share it.
+    del ephemeris.kernel.calls[:]
+    ephemeris.rv_many(pairs, tdb)
+    assert sorted(ephemeris.kernel.calls) == [(0, 3), (0, 4), (3, 301), (3, 399)]
+
+    r, v = ephemeris.rv_many(pairs, 2451545.0)
+    assert r.shape == v.shape == (5, 3)
+
+    with pytest.raises(ValueError):
+        ephemeris.rv_many([(0, 3), (0, 5)], tdb)
+
+
+def test_state_cache(ephemeris):
+    pairs = [(0, 399), (0, 301)]
+    expected = ephemeris.rv_many(pairs, 2451545.0, 0.25)
+    assert ephemeris.cache_info() is None
+
+    ephemeris.enable_cache(maxsize=2)
+    for _ in range(2):
+        r, v = ephemeris.rv_many(pairs, 2451545.0, 0.25)
+        assert np.all(r == expected[0])
+        assert np.all(v == expected[1])
+    info = ephemeris.cache_info()
+    assert (info.hits, info.misses, info.currsize) == (2, 2, 2)
+
+    # Hits don't evaluate any segments.
+    del ephemeris.kernel.calls[:]
+    ephemeris.rv(0, 399, 2451545.0, 0.25)
+    ephemeris.r(0, 301, 2451545.0, 0.25)
+    assert ephemeris.kernel.calls == []
+
+    # Positions can't serve velocity queries.
+    ephemeris.r(0, 4, 2451545.0)
+    r, v = ephemeris.rv(0, 4, 2451545.0)
+    assert np.all(v == 4.0)
+
+    # Array epochs bypass the cache.
+    misses = ephemeris.cache_info().misses
+    ephemeris.rv(0, 399, [2451545.0, 2451546.0])
+    assert ephemeris.cache_info().misses == misses
+
+    info = ephemeris.cache_info()
+    ephemeris._build_index()
+    assert ephemeris.cache_info() == info._replace(currsize=0, nbytes=0)
+
+    # States computed while the index is rebuilt are not kept.
+    compute_states = ephemeris._compute_states
+
+    def rebuild_and_compute(*args, **kwargs):
+        ephemeris._build_index()
+        return compute_states(*args, **kwargs)
+
+    ephemeris._compute_states = rebuild_and_compute
+    ephemeris.rv(0, 399, 2451547.0)
+    assert ephemeris.cache_info().currsize == 0
+    del ephemeris._compute_states
+
+    ephemeris.disable_cache()
+    assert ephemeris.cache_info() is None
+    eph = ephemerides.JPLEphemeris(cache_bytes=1024)
+    assert eph.cache_info().maxbytes == 1024
+
+
+def test_shared_between_threads(ephemeris):
+    ephemeris.enable_cache()
+    queries = [
+        ([(0, 399), (0, 301)], np.linspace(2451545.0, 2451546.0, 7)),
+        ([(301, 4)], np.linspace(2451545.0, 2451546.0, 13)),
+        ([(4, 399), (3, 0), (0, 4)], 2451545.0),
+    ]
+    expected = [ephemeris.rv_many(pairs, tdb) for pairs, tdb in queries]
+    errors = []
+
+    def run(i):
+        pairs, tdb = queries[i % len(queries)]
+        r_expected, v_expected = expected[i % len(queries)]
+        for _ in range(200):
+            r, v = ephemeris.rv_many(pairs, tdb)
+            if not (np.all(r == r_expected) and np.all(v == v_expected)):
+                errors.append(i)
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+
+    # Each thread has its own scratch arrays.
+    workspaces = []
+    thread = threading.Thread(
+        target=lambda: workspaces.append(ephemeris._workspace))
+    thread.start()
+    thread.join()
+    assert workspaces[0] is not ephemeris._workspace
+
+
+def test_kernel_registry(spk_path, tmpdir):
+    eph1 = ephemerides.JPLEphemeris()
+    eph1.load_kernel(spk_path)
+    eph2 = ephemerides.JPLEphemeris()
+    eph2.load_kernel(str(tmpdir.join('.', 'test.bsp')))
+    kernel = eph1.kernel
+    assert eph2.kernel is kernel
+    path = os.path.realpath(spk_path)
+    assert [key[0] for key in ephemerides._registry].count(path) == 1
+
+    # A modified file is opened again.
+    os.utime(spk_path, (0, 0))
+    assert ephemerides.open_kernel(spk_path) is not kernel
+
+    file = kernel.daf.file
+    del eph1, eph2, kernel
+    gc.collect()
+    assert file.closed
+    assert path not in [key[0] for key in ephemerides._registry]
+
+
+def test_close(spk_path):
+    with ephemerides.JPLEphemeris() as eph:
+        eph.load_kernel(spk_path)
+        eph.rv(0, 399, 2451550.0)
+        file = eph.kernel.daf.file
+    assert eph.kernels == ()
+    gc.collect()
+    assert file.closed
+    with pytest.raises(ValueError):
+        eph.rv(0, 399, 2451550.0)
+
+    eph.load_kernel(spk_path)
+    eph.rv(0, 399, 2451550.0)
+
+
+def test_prefetch(spk_path):
+    eph = ephemerides.JPLEphemeris()
+    eph.load_kernel(spk_path)
+    # One record of each segment: 3 * 5 + 2 words.
+    assert eph.prefetch(2451545.0, 2451546.0) >= 2 * 17 * 8
+    assert eph.prefetch(2451400.0, 2451500.0) == 0
+    assert eph.prefetch(2451545.0, 2451545.0 + 64) >= (4 + 16) * 17 * 8
+
+    eph = ephemerides.JPLEphemeris()
+    eph._add_kernel(MockKernel())
+    assert eph.prefetch(2451545.0, 2451546.0) == 0
+
+
+def test_astropy_time(spk_path):
+    eph = ephemerides.JPLEphemeris()
+    eph.load_kernel(spk_path)
+    jd1 = np.full(5, 2451550.0)
+    jd2 = np.linspace(0.0, 1.0, 5)
+    time = Time(jd1, jd2, format='jd', scale='tdb')
+    r, v = eph.rv(0, 399, time)
+    r_expected, v_expected = eph.rv(0, 399, jd1, jd2)
+    assert np.all(r == r_expected)
+    assert np.all(v == v_expected)
+    assert eph.r(0, 399, time[2]).shape == (3,)
+
+    # Other scales are converted, and the last conversion is reused.
+    time = Time(jd1, jd2, format='jd', scale='tt')
+    tdb, tdb2 = ephemerides._tdb(time, 0.0)
+    assert ephemerides._tdb(time, 0.0)[0] is tdb
+    np.testing.assert_allclose((tdb - jd1) + (tdb2 - jd2), 0.0, atol=2e-8)
+    r, _ = eph.rv_many([(0, 399)], time)
+    assert np.all(r[0] == eph.r(0, 399, tdb, tdb2))
+    eph.apparent_rv(0, 399, time)
+
+    with pytest.raises(ValueError):
+        eph.rv(0, 399, time, 0.5)
+
+
+def test_resolve_body():
+    assert ephemerides.resolve_body(399) == 399
+    assert ephemerides.resolve_body(np.int64(301)) == 301
+    assert ephemerides.resolve_body(earth) == 399
+    assert ephemerides.resolve_body(' mars ') == 499
+    assert ephemerides.resolve_body('Earth') == 399
+    assert ephemerides.resolve_body('moon') == 301
+    assert ephemerides.resolve_body('solar_system_barycenter') == 0
+    assert ephemerides.resolve_body('Earth  Barycenter') == 3
+    with pytest.raises(ValueError):
+        ephemerides.resolve_body('Vulcan')
+    with pytest.raises(TypeError):
+        ephemerides.resolve_body(3.0)
+
+
+def test_query_by_body(ephemeris):
+    r, v = ephemeris.rv('SSB', earth, 2451545.0)
+    assert np.all(r == ephemeris.rv(0, 399, 2451545.0)[0])
+    r = ephemeris.r_many([('moon', 'Earth Barycenter')], [2451545.0])
+    assert np.all(r == ephemeris.r_many([(301, 3)], [2451545.0]))
+    assert ephemeris.path('Earth', 'Moon') == [399, 3, 301]
+
+
+def test_pairwise(spk_path):
+    eph = ephemerides.JPLEphemeris()
+    eph.load_kernel(spk_path)
+    bodies = [0, 'Earth Barycenter', earth]
+    tdb = np.linspace(2451546.0, 2451600.0, 7)
+    distance, range_rate = eph.pairwise(bodies, tdb, chunk_size=3)
+    assert distance.shape == range_rate.shape == (3, 3, 7)
+
+    for i, origin in enumerate(bodies):
+        for j, target in enumerate(bodies):
+            r, v = eph.rv(origin, target, tdb)
+            expected = np.linalg.norm(r, axis=0)
+            np.testing.assert_allclose(distance[i, j], expected, rtol=1e-12)
+            if i == j:
+                assert np.all(range_rate[i, j] == 0)
+            else:
+                np.testing.assert_allclose(
+                    range_rate[i, j], np.sum(r * v, axis=0) / expected,
+                    rtol=1e-9)
+
+    out = np.empty((3, 3))
+    d, rr = eph.pairwise(bodies, tdb[2], out_distance=out)
+    assert d is out
+    assert np.all(d == distance[..., 2])
+    assert np.all(rr == range_rate[..., 2])
+
+    chunks = [(t.copy(), d.copy(), rr.copy())
+              for t, d, rr in eph.iter_pairwise(bodies, tdb[0], tdb[-1], 9.0, 4)]
+    assert [len(t) for t, _, _ in chunks] == [4, 2]
+    np.testing.assert_allclose(np.concatenate([c[1] for c in chunks], axis=2),
+                               distance[..., :6], rtol=1e-12)
+
+
+def test_pairwise_without_barycenter():
+    eph = ephemerides.JPLEphemeris()
+    eph._add_kernel(MockKernel([(3, 301, 2.0), (3, 399, 1.0), (399, -5, 5.0)]))
+    bodies = [301, 399, -5]
+    distance, range_rate = eph.pairwise(bodies, [2451545.0, 2451546.0])
+    _, chunk, _ = next(eph.iter_pairwise(bodies, 2451545.0, 2451546.5, 1.0))
+    assert np.all(chunk == distance)
+    for i, origin in enumerate(bodies):
+        for j, target in enumerate(bodies):
+            r = eph.r(origin, target, 2451545.0)
+            assert np.allclose(distance[i, j], np.linalg.norm(r))
+
+
+def test_pickle(spk_path):
+    path = spk_path
+    eph = ephemerides.JPLEphemeris(plan_cache_size=10, cache_size=5)
+    eph.load_kernel(path)
+    r, v = eph.rv(0, 399, 2451550.0)
+
+    data = pickle.dumps(eph)
+    assert len(data) < 1000
+    copy = pickle.loads(data)
+    assert copy._kernels == []
+    assert copy.kernel_paths == eph.kernel_paths
+    assert copy.cache_info().maxsize == 5
+    assert copy._plans.maxsize == 10
+    assert copy.path(0, 399) == [0, 3, 399]
+    assert copy._kernels == []
+
+    r_copy, v_copy = copy.rv(0, 399, 2451550.0)
+    assert len(copy.kernels) == 1
+    assert np.all(r_copy == r)
+    assert np.all(v_copy == v)
+    assert (0, 399) in copy._plans
+
+    # Kernels loaded later take precedence over the unpickled ones.
+    copy = pickle.loads(data)
+    copy.load_kernel(path)
+    assert copy.kernel_paths == eph.kernel_paths * 2
+
+    futures = pytest.importorskip('concurrent.futures')
+    with futures.ProcessPoolExecutor(1) as executor:
+        r_copy, v_copy = executor.submit(eph.rv, 0, 399, 2451550.0).result()
+    assert np.all(r_copy == r)
+
+
+def test_pickle_failure(ephemeris):
+    with pytest.raises(TypeError):
+        pickle.dumps(ephemeris)
+
+
+def test_multiple_kernels(ephemeris):
+    ephemeris._add_kernel(MockKernel([
+        (0, 3, 5.0, 2451545.0, 2451546.0),
+        (0, 3, 6.0, 2451545.5, 2451545.75),
+    ]))
+    assert len(ephemeris.kernels) == 2
+
+    tdb = np.array([2451544.5, 2451545.0, 2451545.5, 2451545.75, 2451546.0,
+                    2451546.5])
+    r, v = ephemeris.rv(0, 3, tdb)
+    assert np.all(r == [[3.0, 5.0, 6.0, 6.0, 5.0, 3.0]] * 3)
+    assert np.all(v == r)
+
+    r, v = ephemeris.rv(0, 3, 2451545.25)
+    assert np.all(r == 5.0)
+
+    # Paths through kernels are combined.
+    r, v = ephemeris.rv(0, 301, 2451545.6)
+    assert np.all(r == 8.0)
+
+
+def test_coverage_gap():
+    eph = ephemerides.JPLEphemeris()
+    eph._add_kernel(MockKernel([
+        (0, 3, 1.0, 2451545.0, 2451546.0),
+        (0, 3, 2.0, 2451547.0, 2451548.0),
+    ]))
+    r, v = eph.rv(0, 3, [2451545.0, 2451546.0, 2451547.0, 2451548.0])
+    assert np.all(r == [[1.0, 1.0, 2.0, 2.0]] * 3)
+
+    for tdb in (2451544.0, 2451546.5, 2451549.0):
+        with pytest.raises(ValueError):
+            eph.rv(0, 3, tdb)
+
+
+def test_position_only(ephemeris):
+    tdb = np.linspace(2451545.0, 2451546.0, 5)
+    r = ephemeris.r(399, 4, tdb)
+    assert r.shape == (3, 5)
+    assert np.all(r == ephemeris.rv(399, 4, tdb)[0])
+    assert ephemeris.r(0, 301, 0).shape == (3,)
+
+    pairs = [(0, 399), (0, 301), (4, 3)]
+    r = ephemeris.r_many(pairs, tdb)
+    assert r.shape == (3, 3, 5)
+    assert np.all(r == ephemeris.rv_many(pairs, tdb)[0])
+
+
+def test_output_arrays(ephemeris):
+    tdb = np.linspace(2451545.0, 2451546.0, 5)
+    out_r = np.empty((3, 5))
+    out_v = np.empty((3, 5))
+    r, v = ephemeris.rv(0, 301, tdb, out_r=out_r, out_v=out_v)
+    assert np.shares_memory(r, out_r)
+    assert np.shares_memory(v, out_v)
+    assert np.all(out_r == 5.0)
+    assert np.all(out_v == 5.0)
+
+    out = np.empty((2, 3, 5))
+    r = ephemeris.r_many([(0, 399), (399, 0)], tdb, out=out)
+    assert r is out
+    assert np.all(out[0] == 4.0)
+    assert np.all(out[1] == -4.0)
+
+    out = np.empty(3)
+    ephemeris.r(3, 399, 0, out=out)
+    assert np.all(out == 1.0)
+
+    with pytest.raises(ValueError):
+        ephemeris.rv(0, 301, tdb, out_r=np.empty((3, 4)))
+
+
+def test_workspace_reuse(ephemeris):
+    tdb = np.linspace(2451545.0, 2451546.0, 5)
+    ephemeris.rv_many([(0, 399), (0, 301)], tdb)
+    buffers = dict(ephemeris._workspace._buffers)
+    ephemeris.rv_many([(0, 399), (0, 301)], tdb)
+    ephemeris.rv_many([(0, 301)], tdb[:3])
+    assert len(ephemeris._workspace._buffers) == len(buffers)
+    for key, buffer in buffers.items():
+        assert ephemeris._workspace._buffers[key] is buffer
+
+
+def test_iter_rv():
+    eph = ephemerides.JPLEphemeris()
+    eph._add_kernel(MockKernel([
+        (0, 3, 1.0, 2451545.0, 2451545.5),
+        (0, 3, 2.0, 2451545.5, 2451546.0),
+    ]))
+    start, stop, step = 2451545.0, 2451546.0, 0.1
+    chunks = list((tdb.copy(), r.copy(), v.copy())
+                  for tdb, r, v in eph.iter_rv(0, 3, start, stop, step, 4))
+    assert [len(tdb) for tdb, _, _ in chunks] == [4, 4, 2]
+
+    tdb = np.concatenate([chunk[0] for chunk in chunks])
+    r = np.concatenate([chunk[1] for chunk in chunks], axis=1)
+    v = np.concatenate([chunk[2] for chunk in chunks], axis=1)
+    np.testing.assert_allclose(tdb, start + step * np.arange(10))
+    r_expected, v_expected = eph.rv(0, 3, start, step * np.arange(10))
+    assert np.all(r == r_expected)
+    assert np.all(v == v_expected)
+
+    # The buffers are reused between chunks.
+    iterator = eph.iter_rv(0, 3, start, stop, step, 4)
+    first = next(iterator)
+    second = next(iterator)
+    for a, b in zip(first, second):
+        assert np.shares_memory(a, b)
+
+    assert list(eph.iter_rv(0, 3, stop, start, step)) == []
+    with pytest.raises(ValueError):
+        next(eph.iter_rv(0, 3, start, stop, 0.0))
+    with pytest.raises(ValueError):
+        next(eph.iter_rv(0, 3, start, stop, step, 0))
@@ -0,0 +1,73 @@
+# coding: utf-8
+from __future__ import absolute_import, division, print_function
+
+import os
+
+import numpy as np
+from jplephem.spk import SPK
+
+import astrodynamics.lowlevel.metadata as metadata
+from astrodynamics.lowlevel.ephemerides import JPLEphemeris
+
+SEGMENTS = [
+    (0, 3, 2451545.0, 16.0, (4, 3, 5)),
+    (3, 301, 2451545.0, 4.0, (16, 6, 5)),
+]
+
+ATTRIBUTES = ('source', 'start_second', 'end_second', 'target', 'center',
+              'frame', 'data_type', 'start_i', 'end_i', 'start_jd', 'end_jd')
+
+
+def test_open_spk(spk_path, tmpdir, monkeypatch):
+    cache = tmpdir.join('metadata')
+    kernel = metadata.open_spk(spk_path, str(cache))
+    assert len(cache.listdir()) == 1
+
+    def fail(*args):
+        raise AssertionError('Summaries were parsed again.')
+
+    with SPK.open(spk_path) as expected:
+        monkeypatch.setattr(SPK, 'open', fail)
+        monkeypatch.setattr(metadata.DAF, 'summaries', fail)
+        cached = metadata.open_spk(spk_path, str(cache))
+        for segment, reference in zip(cached.segments, expected.segments):
+            assert type(segment) is type(reference)
+            for name in ATTRIBUTES:
+                assert getattr(segment, name) == getattr(reference, name)
+        tdb = np.linspace(2451546.0, 2451600.0, 11)
+        assert np.all(cached[3, 301].compute(tdb) == expected[3, 301].compute(tdb))
+    kernel.close()
+    cached.close()
+
+
+def test_modified_file(spk_path, tmpdir):
+    cache = tmpdir.join('metadata')
+    metadata.open_spk(spk_path, str(cache)).close()
+    sidecar = cache.listdir()[0]
+    os.utime(spk_path, (0, 0))
+    metadata.open_spk(spk_path, str(cache)).close()
+    assert '"mtime": 0' in sidecar.read()
+
+    # Corrupt and unwritable caches are ignored.
+    sidecar.write('{')
+    metadata.open_spk(spk_path, str(cache)).close()
+    metadata.open_spk(spk_path, spk_path).close()
+
+
+def test_ephemeris_metadata_dir(spk_path, tmpdir):
+    cache = tmpdir.join('metadata')
+    eph = JPLEphemeris(metadata_dir=str(cache))
+    eph.load_kernel(spk_path)
+    assert eph.path(0, 301) == [0, 3, 301]
+    assert len(cache.listdir()) == 1
+
+
+def test_without_build_segment(spk_path, tmpdir, monkeypatch):
+    cache = str(tmpdir.join('metadata'))
+    metadata.open_spk(spk_path, cache).close()
+    # jplephem versions before build_segment only have Segment.
+    monkeypatch.delattr(metadata.spk, 'build_segment')
+    with metadata.open_spk(spk_path, cache) as kernel:
+        assert all(type(segment) is metadata.spk.Segment
+                   for segment in kernel.segments)
+        assert kernel[0, 3].compute(2451546.0).shape == (3,)
@@ -0,0 +1,51 @@
+# coding: utf-8
+from __future__ import absolute_import, division, print_function
+
+import numpy as np
+import pytest
+
+from astrodynamics.lowlevel.ephemerides import JPLEphemeris
+
+pytest.importorskip('multiprocessing.shared_memory')
+
+
+SEGMENTS = [
+    (0, 3, 2451545.0, 16.0, (20, 3, 11)),
+    (3, 399, 2451545.0, 4.0, (80, 3, 13)),
+]
+
+
+@pytest.fixture
+def ephemeris(spk_path):
+    eph = JPLEphemeris()
+    eph.load_kernel(spk_path)
+    return eph
+
+
+def test_parallel_rv(ephemeris):
+    pairs = [(0, 399), (399, 3)]
+    start, stop, step = 2451545.0, 2451545.0 + 300, 0.1
+    with ephemeris.parallel_rv(pairs, start, stop, step, workers=2,
+                               chunk_size=700) as states:
+        assert states.r.shape == states.v.shape == (2, 3, 3000)
+        r, v = ephemeris.rv_many(pairs, start, step * np.arange(3000))
+        assert np.all(states.r == r)
+        assert np.all(states.v == v)
+        np.testing.assert_allclose(states.tdb, start + step * np.arange(3000))
+    assert states.r is None
+
+
+def test_parallel_rv_errors(ephemeris):
+    with pytest.raises(ValueError):
+        ephemeris.parallel_rv([(0, 301)], 2451545.0, 2451546.0, 0.1)
+    with pytest.raises(ValueError):
+        ephemeris.parallel_rv([(0, 3)], 2451545.0, 2451546.0, 0.0)
+
+    # Epochs outside the kernel fail in the workers.
+    with pytest.raises(ValueError):
+        ephemeris.parallel_rv([(0, 3)], 2451540.0, 2451546.0, 0.1, workers=1)
+
+    eph = JPLEphemeris()
+    eph._add_kernel(ephemeris.kernel)
+    with pytest.raises(ValueError):
+        eph.parallel_rv([(0, 3)], 2451545.0, 2451546.0, 0.1)
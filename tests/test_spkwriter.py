@@ -0,0 +1,200 @@
+# coding: utf-8
+from __future__ import absolute_import, division, print_function
+
+import numpy as np
+import pytest
+from jplephem.spk import SPK
+
+from astrodynamics.__main__ import main
+from astrodynamics.lowlevel.ephemerides import JPLEphemeris
+from astrodynamics.lowlevel.spkwriter import (
+    SPKSegment, _fit_records, cut_segment, fit_chebyshev, write_spk)
+
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+
+T = 2451545.0
+
+SEGMENTS = [
+    (0, 3, T, 8.0, (10, 3, 5)),
+    (0, 4, T, 8.0, (10, 3, 5)),
+    (3, 399, T, 2.0, (40, 6, 4)),
+    (3, 301, T, 2.0, (40, 3, 4)),
+]
+
+
+def test_write_spk(tmpdir):
+    path = str(tmpdir.join('written.bsp'))
+    segments = [
+        SPKSegment(0, target, 1, 8, 0.0, 10.0, [np.arange(target)],
+                   name='segment {}'.format(target))
+        for target in range(1, 31)]
+    comment = 'First line\nsecond line ' + 'x' * 2000
+    write_spk(path, segments, comment)
+
+    kernel = SPK.open(path)
+    assert kernel.daf.comments() == comment
+    summaries = list(kernel.daf.summaries())
+    assert len(summaries) == 30
+    for target, (name, values) in enumerate(summaries, 1):
+        assert name == 'segment {}'.format(target).encode('ascii')
+        assert values[:6] == (0.0, 10.0, target, 0, 1, 8)
+        array = kernel.daf.read_array(*values[6:])
+        assert np.all(array == np.arange(target))
+    kernel.close()
+
+
+def test_cut_segment(spk_path):
+    kernel = SPK.open(spk_path)
+    segment = kernel.segments[2]
+    assert cut_segment(segment, T - 10, T - 1) is None
+
+    cut = cut_segment(segment, T + 5, T + 9.5)
+    assert cut.start_jd == T + 5
+    assert cut.end_jd == T + 9.5
+    records, trailer = cut.data
+    # The records starting at T + 4, T + 6 and T + 8.
+    assert records.size == 3 * 26
+    np.testing.assert_allclose(trailer, [4 * 86400, 2 * 86400, 26, 3])
+
+    # The whole segment.
+    cut = cut_segment(segment, T - 10, T + 100)
+    assert cut.start_jd == T
+    assert cut.end_jd == T + 80
+    assert len(cut) == segment.end_i - segment.start_i + 1
+    kernel.close()
+
+
+def test_write_subset(spk_path, tmpdir):
+    subset = str(tmpdir.join('subset.bsp'))
+    with JPLEphemeris() as eph:
+        eph.load_kernel(spk_path)
+        eph.write_subset(subset, ['moon', 399], T + 5, T + 9.5)
+
+        with JPLEphemeris() as small:
+            small.load_kernel(subset)
+            assert sorted(small._coverage) == [(3, 301), (3, 399)]
+            assert 'test.bsp' in small.kernel.daf.comments()
+
+            tdb = np.linspace(T + 5, T + 9.5, 50)
+            r, v = small.rv(301, 399, tdb)
+            r_expected, v_expected = eph.rv(301, 399, tdb)
+            assert np.all(r == r_expected)
+            assert np.all(v == v_expected)
+            with pytest.raises(ValueError):
+                small.rv(301, 399, T + 10)
+
+        with pytest.raises(ValueError):
+            eph.write_subset(subset, [399, 301], T + 100, T + 101)
+        with pytest.raises(ValueError):
+            eph.write_subset(subset, [399], T, T + 1)
+
+
+def test_main_subset_spk(spk_path, tmpdir):
+    subset = str(tmpdir.join('subset.bsp'))
+    argv = ['__main__.py', 'subset_spk', spk_path, subset, '2000-01-02',
+            str(T + 3), 'ssb', '399']
+    with patch('sys.argv', argv):
+        main()
+    kernel = SPK.open(subset)
+    assert sorted(kernel.pairs) == [(0, 3), (3, 399)]
+    assert [segment.start_jd for segment in kernel.segments] == [T + 0.5] * 2
+    kernel.close()
+
+    argv[-1] = 'tatooine'
+    with patch('sys.argv', argv):
+        with pytest.raises(SystemExit):
+            main()
+
+
+def orbit(tdb):
+    """Circular orbit of 7000 km radius with a period of 0.1 days."""
+    angle = 2 * np.pi * (tdb - T) / 0.1
+    r = 7000 * np.array([np.cos(angle), np.sin(angle), 0.1 * np.sin(angle)])
+    v = 7000 * 2 * np.pi / 0.1 * np.array(
+        [-np.sin(angle), np.cos(angle), 0.1 * np.cos(angle)])
+    return r, v
+
+
+@pytest.mark.parametrize('data_type', [2, 3])
+def test_fit_chebyshev(tmpdir, data_type):
+    tdb = T + np.arange(0, 2 + 1e-9, 1 / 1440)
+    r, v = orbit(tdb)
+    segment = fit_chebyshev(399, -1000, tdb, r, v, tolerance=1e-4,
+                            data_type=data_type, name='orbit')
+    records, trailer = segment.data
+    init, intlen, rsize, n = trailer
+    assert rsize == 2 + 13 * (3 if data_type == 2 else 6)
+    assert init == 0.0
+    assert intlen * n == 2 * 86400
+    # Fewer records would not meet the tolerance.
+    assert fit_chebyshev(399, -1000, tdb, r, v, tolerance=1e-4 * 2 ** -6,
+                         data_type=data_type).data[1][3] > n
+
+    path = str(tmpdir.join('orbit.bsp'))
+    write_spk(path, [segment])
+    with JPLEphemeris() as eph:
+        eph.load_kernel(path)
+        # The distance to the samples is within the tolerance.
+        error = np.linalg.norm(eph.r(399, -1000, tdb) - r, axis=0)
+        assert np.max(error) <= 1e-4
+        # Between the samples.
+        tdb = T + np.linspace(0, 2, 997)
+        r_expected, v_expected = orbit(tdb)
+        r, v = eph.rv(399, -1000, tdb)
+        np.testing.assert_allclose(r, r_expected, rtol=0, atol=1e-4)
+        np.testing.assert_allclose(v, v_expected, rtol=0, atol=0.1)
+
+
+def test_fit_position_error():
+    t = np.linspace(0, 1, 50)
+    f = np.sin(5 * t)
+    # Equal residuals in all components, so that their distance is sqrt(3)
+    # times the residual of each.
+    coefficients, error = _fit_records(
+        t, np.zeros(50, dtype=int), np.array([50]), 1.0, np.array([f, f, f]),
+        None, 3)
+    residuals = np.polynomial.chebyshev.chebval(
+        2 * t - 1, coefficients[0, 0]) - f
+    assert np.isclose(error, np.sqrt(3) * np.max(np.abs(residuals)))
+
+
+def test_fit_chebyshev_errors():
+    tdb = T + np.arange(0, 1, 1 / 24)
+    r, v = orbit(tdb)
+    with pytest.raises(ValueError):
+        fit_chebyshev(399, -1000, tdb, r, data_type=3)
+    with pytest.raises(ValueError):
+        fit_chebyshev(399, -1000, tdb[::-1], r)
+    with pytest.raises(ValueError):
+        fit_chebyshev(399, -1000, tdb, r[:2])
+    # Too few samples per orbit.
+    with pytest.raises(ValueError):
+        fit_chebyshev(399, -1000, tdb, r, v, tolerance=1e-6)
+
+
+def test_fit_chebyshev_last_sample(tmpdir):
+    rng = np.random.RandomState(4)
+    segments = []
+    for target in range(-1000, -1040, -1):
+        tdb = T + rng.uniform(8000, 9000) + np.linspace(
+            0, rng.uniform(0.3, 3), 400)
+        # Slowed down to a period of two days.
+        r, _ = orbit(T + (tdb - T) / 20)
+        segments.append(fit_chebyshev(399, target, tdb, r))
+    path = str(tmpdir.join('orbits.bsp'))
+    write_spk(path, segments)
+
+    with JPLEphemeris() as eph:
+        eph.load_kernel(path)
+        for segment in eph.kernel.segments:
+            init, intlen, _, n = segment.daf.read_array(
+                segment.end_i - 3, segment.end_i)
+            assert segment.end_second <= init + intlen * n
+            # jplephem rejects epochs past the end of the last record.
+            segment.compute_and_differentiate(segment.end_jd)
+            r = eph.r(399, segment.target, segment.end_jd)
+            r_expected, _ = orbit(T + (segment.end_jd - T) / 20)
+            np.testing.assert_allclose(r, r_expected, rtol=0, atol=1e-2)
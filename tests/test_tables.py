@@ -0,0 +1,98 @@
+# coding: utf-8
+from __future__ import absolute_import, division, print_function
+
+import numpy as np
+import pytest
+
+from astrodynamics.lowlevel.ephemerides import JPLEphemeris
+from astrodynamics.lowlevel.tables import InterpolationTable
+
+from .spkfile import ChebyshevData
+
+START = 2451545.0
+
+
+@pytest.fixture
+def ephemeris(write_kernel):
+    rng = np.random.RandomState(0)
+    coefficients = rng.uniform(-1, 1, (1, 3, 8)) / 2.0 ** np.arange(8)
+    eph = JPLEphemeris()
+    eph.load_kernel(write_kernel([ChebyshevData(0, 3, START, 32.0, coefficients)]))
+    return eph
+
+
+def test_precompute(ephemeris):
+    table = ephemeris.precompute(0, 3, START + 1, START + 21, 0.05)
+    assert ephemeris.tables == (table,)
+    assert table.stop >= START + 21
+    assert table.max_error < 1e-3
+
+    tdb = np.linspace(START + 1, START + 21, 1001)
+    r, v = ephemeris.rv(0, 3, tdb)
+    ephemeris.remove_table(0, 3)
+    r_expected, v_expected = ephemeris.rv(0, 3, tdb)
+    assert np.max(np.abs(r - r_expected)) <= table.max_error
+    np.testing.assert_allclose(v, v_expected, rtol=0, atol=1e-2)
+
+    with pytest.raises(ValueError):
+        ephemeris.precompute(0, 3, START + 21, START + 1, 0.05)
+    assert ephemeris.tables == ()
+
+
+def test_table_serves_queries(ephemeris):
+    table = ephemeris.precompute(0, 3, START + 1, START + 3, 0.5)
+    kernel = ephemeris.kernel
+    ephemeris._kernels = []
+    ephemeris._build_index()
+
+    # Queries within the table need no kernel, in both directions.
+    r, v = ephemeris.rv(0, 3, START + 2, 0.25)
+    r_expected, v_expected = table.compute_and_differentiate(START + 2.25)
+    assert np.all(r == r_expected)
+    assert np.all(v == v_expected)
+    r = ephemeris.r_many([(3, 0)], [START + 1, START + 3])
+    assert np.all(r[0] == -table.compute_and_differentiate(
+        [START + 1, START + 3])[0])
+
+    with pytest.raises(ValueError):
+        ephemeris.rv(0, 3, START + 4)
+    ephemeris._add_kernel(kernel)
+    ephemeris.rv(0, 3, START + 4)
+
+
+def test_samples_are_exact(ephemeris):
+    table = ephemeris.precompute(0, 3, START, START + 10, 1.0)
+    ephemeris.remove_table(0, 3)
+    r, v = ephemeris.rv(0, 3, START + np.arange(11.0))
+    assert np.all(r == table.positions)
+    assert np.all(v == table.velocities)
+    r_table, v_table = table.compute_and_differentiate(START + np.arange(11.0))
+    np.testing.assert_allclose(r_table, r, rtol=1e-14)
+    np.testing.assert_allclose(v_table, v, rtol=1e-12)
+
+
+def test_tolerance(ephemeris):
+    with pytest.raises(ValueError):
+        ephemeris.precompute(0, 3, START, START + 10, 2.0, tolerance=1e-6)
+    assert ephemeris.tables == ()
+
+
+def test_save_load(ephemeris, tmpdir):
+    table = ephemeris.precompute(0, 3, START, START + 10, 0.5)
+    path = str(tmpdir.join('table.npz'))
+    table.save(path)
+    loaded = InterpolationTable.load(path)
+    assert (loaded.origin, loaded.target) == (0, 3)
+    assert (loaded.start, loaded.step) == (table.start, table.step)
+    assert loaded.max_error == table.max_error
+    assert np.all(loaded.positions == table.positions)
+    assert np.all(loaded.velocities == table.velocities)
+
+
+def test_invalid_table():
+    with pytest.raises(ValueError):
+        InterpolationTable(0, 3, START, 1.0, np.zeros((3, 1)), np.zeros((3, 1)))
+    with pytest.raises(ValueError):
+        InterpolationTable(0, 3, START, 1.0, np.zeros((3, 2)), np.zeros((3, 3)))
+    with pytest.raises(ValueError):
+        InterpolationTable(0, 3, START, 0.0, np.zeros((3, 2)), np.zeros((3, 2)))